@@ -26,10 +26,11 @@ documentation for further details.'''
 # copyright: (c) 2012 James Spencer
 # license: modified BSD; see LICENSE for more details
 
-import glob
+import fnmatch
 import optparse
 import os
 import re
+import shlex
 import subprocess
 import sys
 import threading
@@ -51,6 +52,9 @@ import testcode2.compatibility
 import testcode2.exceptions
 import testcode2.validation
 
+ALLOWED_ACTIONS = frozenset(['compare', 'run', 'diff', 'tidy',
+                             'make-benchmarks', 'recheck'])
+
 #--- testcode initialisation ---
 
 def init_tests(userconfig, jobconfig, test_id, reuse_id, executables=None,
@@ -82,14 +86,14 @@ test_programs: dict of the test programs defined in userconfig.
 tests: list of selected tests.
 '''
 
-    config_exists = os.path.exists(userconfig) and os.path.exists(jobconfig)
-
+    # Only check whether the configuration files exist (in order to give a more
+    # helpful error message) if there is a problem reading them.
     try:
         (user_options, test_programs) = testcode2.config.parse_userconfig(
                 userconfig, executables, test_id, userconfig_options)
     except testcode2.exceptions.TestCodeError:
         err = str(sys.exc_info()[1])
-        if not config_exists:
+        if not (os.path.exists(userconfig) and os.path.exists(jobconfig)):
             err += (' Please run from a directory containing (or specify) the '
                     'userconfig file. Use ``--help`` to see available options.')
         raise testcode2.exceptions.TestCodeError(err)
@@ -104,7 +108,7 @@ tests: list of selected tests.
                 jobconfig, user_options, test_programs, jobconfig_options)
     except testcode2.exceptions.TestCodeError:
         err = str(sys.exc_info()[1])
-        if not config_exists:
+        if not (os.path.exists(userconfig) and os.path.exists(jobconfig)):
             err += (' Please run from a directory containing (or specify) the '
                     'jobconfig file. Use ``--help`` to see available options.')
         raise testcode2.exceptions.TestCodeError(err)
@@ -151,9 +155,6 @@ actions: list of testcode2 actions to run.
     # Curse not being able to use argparse in order to support python <= 2.7!
     parser = optparse.OptionParser(usage=__doc__)
 
-    allowed_actions = ['compare', 'run', 'diff', 'tidy', 'make-benchmarks',
-                       'recheck']
-
     parser.add_option('-b', '--benchmark', help='Set the file ID of the '
             'benchmark files.  Default: specified in the [user] section of the '
             'userconfig file.')
@@ -173,6 +174,12 @@ actions: list of testcode2 actions to run.
             dest='first_run', help='Run tests that were not were not run in '
             'the previous testcode run.  Only relevant to the recheck action.  '
             'Default: %default.')
+    parser.add_option('--hardlink', action='store_true', default=False,
+            help='Create benchmark files as hard links to the test outputs '
+            '(and other files produced by the tests) where possible rather '
+            'than copying them.  Any subsequent changes to a test output then '
+            'also change the benchmark file.  Only relevant to the '
+            'make-benchmarks action.  Default: %default.')
     parser.add_option('-i', '--insert', action='store_true', default=False,
             help='Insert the new benchmark into the existing list of benchmarks'
             ' in userconfig rather than overwriting it.  Only relevant to the'
@@ -183,6 +190,11 @@ actions: list of testcode2 actions to run.
             default=[], nargs=3, help='Override/add setting to jobconfig.  '
             'Takes three arguments.  Format: section_name option_name value.  '
             'Default: none.')
+    parser.add_option('--no-cache', action='store_false', default=True,
+            dest='use_caches', help='Rerun all tests and analyse all outputs '
+            'rather than reusing previous passes and extracted data (see the '
+            'cache_passes and cache_extracts settings in userconfig).  The '
+            'caches are still updated.  Default: use caches if enabled.')
     parser.add_option('--older-than', type='int', dest='older_than', default=14,
             help='Set the age (in days) of files to remove.  Only relevant to '
             'the tidy action.  Default: %default days.')
@@ -200,9 +212,13 @@ actions: list of testcode2 actions to run.
             'if running tests and most recent test_id if comparing tests.')
     parser.add_option('--total-processors', type='int', default=-1,
             dest='tot_nprocs', help='Set the total number of processors to use '
-            'to run tests concurrently.  Relevant only to the run option.  '
-            'Default: run all tests concurrently run if --submit is used; run '
-            'tests sequentially otherwise.')
+            'to run tests concurrently.  Relevant only to the run and recheck '
+            'options; compare (and recheck) also use it as the number of '
+            'comparisons to perform at the same time and make-benchmarks as '
+            'the number of tests to copy files for at the same time.  '
+            'Default: run all tests '
+            'concurrently run if --submit is used; run tests sequentially '
+            'otherwise.')
     parser.add_option('--userconfig', default='userconfig', help='Set path to '
             'the user configuration file.  Default: %default.')
     parser.add_option('--user-option', action='append', dest='user_option',
@@ -230,9 +246,10 @@ actions: list of testcode2 actions to run.
         if 'run' in args and 'make-benchmarks' not in args:
             options.category = ['_default_']
 
-    test_args = (arg not in allowed_actions for arg in args)
-    if testcode2.compatibility.compat_any(test_args):
-        print('At least one action is not understood: %s.' % (' '.join(args)))
+    unknown_actions = testcode2.compatibility.compat_set(args) - ALLOWED_ACTIONS
+    if unknown_actions:
+        print('Action(s) not understood: %s.'
+                % (' '.join(sorted(unknown_actions))))
         parser.print_usage()
         sys.exit(1)
 
@@ -240,7 +257,7 @@ actions: list of testcode2 actions to run.
     # parse_userconfig.
     exe = {}
     for item in options.executable:
-        words = item.split('=')
+        words = item.split('=', 1)
         if len(words) == 1:
             # setting executable for all programs (unless otherwise specified)
             exe['_tc_all'] = words[0]
@@ -251,32 +268,58 @@ actions: list of testcode2 actions to run.
 
     # Set FILESTEM if test_id refers to a benchmark file or the benchmark
     # refers to a test_id.
+    test_stem = testcode2.FILESTEM['test']
+    benchmark_stem = testcode2.FILESTEM['benchmark']
     filestem = testcode2.FILESTEM.copy()
     if options.benchmark and options.benchmark[:2] == 't:':
-        filestem['benchmark'] = testcode2.FILESTEM['test']
+        filestem['benchmark'] = test_stem
         options.benchmark = options.benchmark[2:]
     if options.test_id and options.test_id[:2] == 'b:':
-        filestem['test'] = testcode2.FILESTEM['benchmark']
+        filestem['test'] = benchmark_stem
         options.test_id = options.test_id[2:]
-    if filestem['test'] != testcode2.FILESTEM['test'] and 'run' in args:
+    if filestem['test'] != test_stem and 'run' in args:
         print('Not allowed to set test filename to be a benchmark filename '
                 'when running calculations.')
         sys.exit(1)
-    testcode2.FILESTEM = filestem.copy()
+    # filestem is a new dict, so no need to copy it again.
+    testcode2.FILESTEM = filestem
 
     # Convert job-options and user-options to dict of dicsts format.
     for item in ['user_option', 'job_option']:
-        uj_opt = getattr(options, item)
-        opt = dict( (section, {}) for section in
-                testcode2.compatibility.compat_set(opt[0] for opt in uj_opt) )
-        for (section, option, value) in uj_opt:
-            opt[section][option] = value
+        opt = {}
+        for (section, option, value) in getattr(options, item):
+            opt.setdefault(section, {})[option] = value
         setattr(options, item, opt)
 
     return (options, args)
 
 #--- actions ---
 
+def run_threads(nthreads, target, args):
+    '''Run target(*args) in each of nthreads threads and wait for them to finish.
+
+The threads are daemonised, so they are terminated if testcode is killed.
+'''
+    threads = [threading.Thread(target=target, args=args)
+                   for i in range(nthreads)]
+    for thread in threads:
+        # daemonise so thread terminates when master dies
+        try:
+            thread.setDaemon(True)
+        except AttributeError:
+            thread.daemon = True
+        thread.start()
+
+    # We avoid .join() without a timeout, which is blocking making it
+    # unresponsive to TERM.  join(timeout) returns as soon as the thread
+    # finishes, so there is no delay in noticing all threads have completed.
+    for thread in threads:
+        # is_alive is not available before python 2.6 and isAlive was removed
+        # in python 3.9.
+        is_alive = getattr(thread, 'is_alive', None) or thread.isAlive
+        while is_alive():
+            thread.join(0.5)
+
 def run_tests(tests, verbose=1, cluster_queue=None, tot_nprocs=0):
     '''Run tests.
 
@@ -291,41 +334,53 @@ tot_nprocs: total number of processors available to run tests on.  As many
     the same time.  If less than one and cluster_queue is not set, then
     tot_nprocs is ignored and the tests are run sequentially (default).
 '''
-    def run_test_worker(semaphore, semaphore_lock, tests, *run_test_args):
-        '''Launch a test after waiting until resources are available to run it.
+    def run_test_worker(semaphore, semaphore_lock, test_queue, *run_test_args):
+        '''Launch tests after waiting until resources are available to run them.
 
 semaphore: threading.Semaphore object containing the number of cores/processors
     which can be used concurrently to run tests.
 semaphore.lock: threading.Lock object used to restrict acquiring the semaphore
     to one thread at a time.
-tests: list of (serialized) tests to run in this thread.
+test_queue: queue of lists of (serialized) batches of tests.  Lists of batches
+    are taken from the queue and run until the queue is empty.  All tests in
+    a batch are run in the same job and use the same number of processors.
 run_test_args: arguments to pass to test.run_test method.
 '''
 
-        # Ensure that only one test attempts to register resources with the
-        # semaphore at a time.  This restricts running the tests to a LIFO
-        # fashion which is not perfect (we don't attempt to backfill with
-        # smaller tests, for example) but is a reasonable and (most
-        # importantly) simple first-order approach.
-        for test in tests:
-            semaphore_lock.acquire()
-            # test.nprocs is <1 when program is run in serial.
-            nprocs_used = max(1, test.nprocs)
-            for i in range(nprocs_used):
-                semaphore.acquire()
-            semaphore_lock.release()
-
-            test.run_test(*run_test_args)
-
-            for i in range(nprocs_used):
-                semaphore.release()
+        while True:
+            try:
+                batches = test_queue.get_nowait()
+            except compat.queue.Empty:
+                return
+            # Ensure that only one test attempts to register resources with
+            # the semaphore at a time.  This restricts running the tests to
+            # a LIFO fashion which is not perfect (we don't attempt to
+            # backfill with smaller tests, for example) but is a reasonable
+            # and (most importantly) simple first-order approach.
+            for batch in batches:
+                semaphore_lock.acquire()
+                # test.nprocs is <1 when program is run in serial.
+                nprocs_used = max(1, batch[0].nprocs)
+                for i in range(nprocs_used):
+                    semaphore.acquire()
+                semaphore_lock.release()
+
+                # Always return the processors, even if the test raises an
+                # exception, so that other tests are not blocked forever.
+                try:
+                    if len(batch) > 1:
+                        testcode2.run_test_batch(batch, *run_test_args)
+                    else:
+                        batch[0].run_test(*run_test_args)
+                finally:
+                    for i in range(nprocs_used):
+                        semaphore.release()
 
     # Check executables actually exist...
     compat = testcode2.compatibility
-    executables = [test.test_program.exe for test in tests]
-    executables = compat.compat_set(executables)
+    executables = dict.fromkeys(test.test_program.exe for test in tests)
+    mswin = sys.platform.startswith('win') or sys.platform.startswith('cyg')
     for exe in executables:
-        mswin = sys.platform.startswith('win') or sys.platform.startswith('cyg')
         # The test is not reliable if there's an unholy combination of windows
         # and cygwin being used to run the program.  We've already warned the
         # user (in config.set_program_name) that we struggled to find the
@@ -334,9 +389,13 @@ run_test_args: arguments to pass to test.run_test method.
             err = 'Executable does not exist: %s.' % (exe)
             raise testcode2.exceptions.TestCodeError(err)
 
+    # Jobs shared between tests are run once in each run of the tests.
+    testcode2.reset_started_jobs()
+
     if tot_nprocs <= 0 and cluster_queue:
         # Running on cluster.  Default to submitting all tests at once.
-        tot_nprocs = sum(test.nprocs for test in tests)
+        # test.nprocs is <1 when program is run in serial.
+        tot_nprocs = sum(max(1, test.nprocs) for test in tests)
 
     if tot_nprocs > 0:
         # Allow at most tot_nprocs cores to be used at once by tests.
@@ -351,78 +410,109 @@ run_test_args: arguments to pass to test.run_test method.
         # patterns in the output file--otherwise we can't figure out which
         # output file belongs to which test.  We might be able to for some
         # wildcards, but let's err on the side of caution.
+        # Other tests may be submitted to a queueing system in batches (run
+        # one after another in a single job) if the test program allows it.
         wildcards = re.compile('.*(\*|\?|\[.*\]).*')
         serialized_tests = []
         test_store = {}
+        batch_store = {}
         for test in tests:
             if test.output and wildcards.match(test.output):
                 if test.path in test_store:
                     test_store[test.path].append(test)
                 else:
                     test_store[test.path] = [test]
+            elif cluster_queue and test.test_program.submit_batch_size > 1:
+                key = (test.test_program.name, test.submit_template,
+                       test.nprocs)
+                batch_store.setdefault(key, []).append(test)
             else:
-                serialized_tests.append([test])
+                serialized_tests.append([[test]])
         for (key, stests) in test_store.items():
             if (len(stests) > 1) and verbose > 2:
                 print('Warning: cannot run tests in %s concurrently.' % stests[0].path)
-        serialized_tests += test_store.values()
+            serialized_tests.append([[test] for test in stests])
+        for btests in batch_store.values():
+            batch_size = btests[0].test_program.submit_batch_size
+            for ind in range(0, len(btests), batch_size):
+                serialized_tests.append([btests[ind:ind+batch_size]])
 
         semaphore = threading.BoundedSemaphore(tot_nprocs)
         slock = threading.Lock()
-        jobs = [threading.Thread(
-                    target=run_test_worker,
-                    args=(semaphore, slock, test, verbose, cluster_queue,
-                          os.getcwd())
-                                )
-                    for test in serialized_tests]
-        for job in jobs:
-            # daemonise so thread terminates when master dies
-            try:
-                job.setDaemon(True)
-            except AttributeError:
-                job.daemon = True  
-            job.start()
-
-        # We avoid .join() which is blocking making it unresponsive to TERM
-        while threading.activeCount() > 1:
-            time.sleep(0.5)
+        # Each test uses at least one processor, so no more than tot_nprocs
+        # tests can be run at once.  Use a fixed pool of threads rather than
+        # one thread per (set of serialized) test(s).
+        test_queue = compat.queue.Queue()
+        for stests in serialized_tests:
+            test_queue.put(stests)
+        nthreads = min(tot_nprocs, len(serialized_tests))
+        run_threads(nthreads, run_test_worker,
+                    (semaphore, slock, test_queue, verbose, cluster_queue,
+                     os.getcwd()))
     else:
         # run straight through, one at a time
         for test in tests:
             test.run_test(verbose, cluster_queue, os.getcwd())
 
 
-def compare_tests(tests, verbose=1):
+def compare_tests(tests, verbose=1, tot_nprocs=0):
     '''Compare tests.
 
 tests: list of tests.
 verbose: level of verbosity in output.
+tot_nprocs: number of comparisons to perform at the same time.  If less than 2,
+    the comparisons are done sequentially (default).
 
 Returns:
 
 number of tests not checked due to test output file not existing.
 '''
+    def verify_job_worker(job_queue, verbose, rundir):
+        '''Compare jobs taken from job_queue until the queue is empty.
+
+job_queue: queue of (test, input file, arguments) tuples.
+verbose: level of verbosity in output.
+rundir: directory testcode was launched from.
+'''
+        while True:
+            try:
+                (test, inp, args) = job_queue.get_nowait()
+            except compat.queue.Empty:
+                return
+            test.verify_job(inp, args, verbose, rundir)
 
+    compat = testcode2.compatibility
+    rundir = os.getcwd()
     not_checked = 0
 
+    # Checking whether the test output exists is cheap, so do so up front and
+    # only queue the (potentially expensive) comparisons.
+    jobs = []
     for test in tests:
         for (inp, args) in test.inputs_args:
-            test_file = testcode2.util.testcode_filename(
-                    testcode2.FILESTEM['test'],
-                    test.test_program.test_id, inp, args
-                    )
-            test_file = os.path.join(test.path, test_file)
+            test_file = os.path.join(test.path,
+                                     test.test_program.test_file(inp, args))
             if os.path.exists(test_file):
-                test.verify_job(inp, args, verbose, os.getcwd())
+                jobs.append((test, inp, args))
             else:
                 if verbose > 0 and verbose <= 2:
-                    info_line = testcode2.util.info_line(test.path, inp, args, os.getcwd())
+                    info_line = testcode2.util.info_line(test.path, inp, args, rundir)
                     print('%sNot checked.' % info_line)
                 if verbose > 1:
                     print('Skipping comparison.  '
                           'Test file does not exist: %s.\n' % test_file)
                 not_checked += 1
 
+    nthreads = min(tot_nprocs, len(jobs))
+    if nthreads > 1:
+        job_queue = compat.queue.Queue()
+        for job in jobs:
+            job_queue.put(job)
+        run_threads(nthreads, verify_job_worker, (job_queue, verbose, rundir))
+    else:
+        for (test, inp, args) in jobs:
+            test.verify_job(inp, args, verbose, rundir)
+
     return not_checked
 
 def recheck_tests(tests, verbose=1, cluster_queue=None, tot_nprocs=0,
@@ -453,7 +543,7 @@ not_checked: number of tests not checked due to missing test output.
 
     sys.stdout.write('Comparing tests to benchmarks:'+sep)
 
-    not_checked = compare_tests(tests, verbose)
+    not_checked = compare_tests(tests, verbose, tot_nprocs)
     end_status(tests, not_checked, verbose, False)
 
     rerun_tests = []
@@ -487,9 +577,9 @@ diff_program: diff program to use.
 verbose: level of verbosity in output.
 '''
 
+    # Find all pairs of files to diff before running any diff program.
+    diffs = []
     for test in tests:
-        cwd = os.getcwd()
-        os.chdir(test.path)
         for (inp, args) in test.inputs_args:
             have_benchmark = True
             try:
@@ -499,11 +589,8 @@ verbose: level of verbosity in output.
             except testcode2.exceptions.TestCodeError:
                 err = sys.exc_info()[1]
                 have_benchmark = False
-            test_file = testcode2.util.testcode_filename(
-                    testcode2.FILESTEM['test'],
-                    test.test_program.test_id, inp, args
-                    )
-            if not os.path.exists(test_file):
+            test_file = test.test_program.test_file(inp, args)
+            if not os.path.exists(os.path.join(test.path, test_file)):
                 if verbose > 0:
                     print('Skipping diff with %s in %s: %s does not exist.'
                             % (benchmark, test.path, test_file))
@@ -511,13 +598,21 @@ verbose: level of verbosity in output.
                 if verbose > 0:
                     print('Skipping diff with %s. %s' % (test.path, err))
             else:
-                if verbose > 0:
-                    print('Diffing %s and %s in %s.' %
-                            (benchmark, test_file, test.path))
-                diff_cmd = '%s %s %s' % (diff_program, benchmark, test_file)
-                diff_popen = subprocess.Popen(diff_cmd, shell=True)
-                diff_popen.wait()
-        os.chdir(cwd)
+                diffs.append((test.path, benchmark, test_file))
+
+    # Run diffs one at a time: the diff program might well be interactive
+    # (e.g. vimdiff), so its output cannot be captured and diffs cannot be
+    # run concurrently.  Run each diff in the test directory rather than
+    # changing the current working directory.  The diff program is run
+    # directly rather than via a shell, which also means filenames need not
+    # be escaped.
+    diff_argv = shlex.split(diff_program)
+    for (path, benchmark, test_file) in diffs:
+        if verbose > 0:
+            print('Diffing %s and %s in %s.' % (benchmark, test_file, path))
+        diff_popen = subprocess.Popen(diff_argv + [benchmark, test_file],
+                                      cwd=path)
+        diff_popen.wait()
 
 def tidy_tests(tests, ndays):
     '''Tidy up test directories.
@@ -541,21 +636,36 @@ ndays: test files older than ndays are deleted.
     if ans == 'n':
         print('No files deleted.')
     else:
+        compat = testcode2.compatibility
+        # Match filenames against all globs at once using a single regular
+        # expression rather than calling fnmatch for each glob in turn.  As
+        # for fnmatch.fnmatch, both the globs and the filenames are normalised
+        # using os.path.normcase (which is case-insensitive on some
+        # platforms).
+        test_regex = '|'.join(fnmatch.translate(os.path.normcase(file_glob))
+                                  for file_glob in test_globs)
+        # Compile the expression once for each distinct submit template.
+        file_regexes = {None: re.compile(test_regex)}
         for test in tests:
-            cwd = os.getcwd()
-            os.chdir(test.path)
-            if test.submit_template:
-                file_globs = test_globs + [test.submit_template]
-            else:
-                file_globs = test_globs
-            for file_glob in file_globs:
-                for test_file in glob.glob(file_glob):
-                    if os.stat(test_file)[-2] < epoch_time:
-                        os.remove(test_file)
-            os.chdir(cwd)
+            submit_template = test.submit_template or None
+            if submit_template not in file_regexes:
+                # Submit files are created in the test directory and named
+                # using the submit template and the test id.
+                submit_glob = os.path.normcase('%s.*' %
+                                        os.path.basename(submit_template))
+                file_regexes[submit_template] = re.compile('%s|%s' %
+                        (test_regex, fnmatch.translate(submit_glob)))
+            file_regex = file_regexes[submit_template]
+            # A single pass over the directory: scandir entries cache the file
+            # type and (on some platforms) stat information.
+            for entry in compat.scandir(test.path):
+                if (file_regex.match(os.path.normcase(entry.name)) and
+                        entry.is_file() and
+                        entry.stat().st_mtime < epoch_time):
+                    os.remove(entry.path)
 
 def make_benchmarks(test_programs, tests, userconfig, copy_files_since,
-        insert_id=False):
+        insert_id=False, tot_nprocs=0, hardlink=False):
     '''Make a new set of benchmarks.
 
 test_programs: dictionary of test programs.
@@ -566,12 +676,35 @@ copy_files_since: files produced since the timestamp (in seconds since the
 insert_id: insert the new benchmark id into the existing list of benchmark ids in
     userconfig if True, otherwise overwrite the existing benchmark ids with the
     new benchmark id (default).
+tot_nprocs: number of tests for which to create benchmarks at the same time.
+    If less than 2, the benchmarks are created sequentially (default).
+hardlink: create benchmark files as hard links to the test files where possible
+    rather than copying them.
 '''
+    def create_benchmarks_worker(test_queue, benchmark, copy_files_since,
+            hardlink):
+        '''Create benchmarks for tests taken from test_queue until it is empty.
+
+test_queue: queue of tests.
+benchmark: benchmark id.
+copy_files_since: files produced since the timestamp are also copied.
+hardlink: hard link rather than copy files where possible.
+'''
+        while True:
+            try:
+                test = test_queue.get_nowait()
+            except testcode2.compatibility.queue.Empty:
+                return
+            test.create_new_benchmarks(benchmark, copy_files_since,
+                                       hardlink=hardlink)
 
     # All tests passed?
-    statuses = [test.get_status() for test in tests]
-    npassed = sum(status['passed'] for status in statuses)
-    nran = sum(status['ran'] for status in statuses)
+    npassed = 0
+    nran = 0
+    for test in tests:
+        status = test.get_status()
+        npassed += status['passed']
+        nran += status['ran']
     if npassed != nran:
         ans = ''
         print('Not all tests passed.')
@@ -583,9 +716,14 @@ insert_id: insert the new benchmark id into the existing list of benchmark ids i
 
     # Get vcs info.
     vcs = {}
+    # Programs often share a repository: only query each repository once.
+    code_ids = {}
     for (key, program) in test_programs.items():
         if program.vcs and program.vcs.vcs:
-            vcs[key] = program.vcs.get_code_id()
+            repository = (program.vcs.vcs, program.vcs.repository)
+            if repository not in code_ids:
+                code_ids[repository] = program.vcs.get_code_id()
+            vcs[key] = code_ids[repository]
         else:
             print('Program not under (known) version control system')
             vcs[key] = testcode2.compatibility.compat_input(
@@ -600,17 +738,27 @@ insert_id: insert the new benchmark id into the existing list of benchmark ids i
             benchmark.append('%s-%s' % (key, code_id))
         benchmark = '.'.join(benchmark)
 
-    # Create benchmarks.
-    for test in tests:
-        test.create_new_benchmarks(benchmark, copy_files_since)
+    # Create benchmarks.  This is dominated by file copies, so the copies for
+    # different tests can be overlapped.
+    nthreads = min(tot_nprocs, len(tests))
+    if nthreads > 1:
+        test_queue = testcode2.compatibility.queue.Queue()
+        for test in tests:
+            test_queue.put(test)
+        run_threads(nthreads, create_benchmarks_worker,
+                    (test_queue, benchmark, copy_files_since, hardlink))
+    else:
+        for test in tests:
+            test.create_new_benchmarks(benchmark, copy_files_since,
+                                       hardlink=hardlink)
 
     # update userconfig file.
     if userconfig:
-        config = testcode2.compatibility.configparser.RawConfigParser()
-        config.optionxform = str # Case sensitive file.
-        config.read(userconfig)
         if insert_id:
-            ids = config.get('user', 'benchmark').split()
+            # Use the (cached) settings read in by testcode2.config rather than
+            # reading and parsing userconfig again.
+            config = testcode2.config.read_config(userconfig)
+            ids = config['user'].get('benchmark', '').split()
             if benchmark in ids:
                 ids.remove(benchmark)
             ids.insert(0, benchmark)
@@ -621,10 +769,8 @@ insert_id: insert the new benchmark id into the existing list of benchmark ids i
         else:
             print('Setting new benchmark in userconfig to be: %s.' %
                     (benchmark))
-        config.set('user', 'benchmark', benchmark)
-        userconfig = open(userconfig, 'w')
-        config.write(userconfig)
-        userconfig.close()
+        testcode2.config.set_config_option(userconfig, 'user', 'benchmark',
+                                           benchmark)
 
 #--- info output ---
 
@@ -637,8 +783,9 @@ verbose: level of verbosity in output (no output if <1).
 '''
 
     if verbose > 0:
-        exes = [test.test_program.exe for test in tests]
-        exes = testcode2.compatibility.compat_set(exes)
+        # Distinct executables in a single pass (and, where dictionaries are
+        # ordered, in the order they are first used).
+        exes = dict.fromkeys(test.test_program.exe for test in tests)
         if running:
             for exe in exes:
                 print('Using executable: %s.' % (exe))
@@ -667,19 +814,10 @@ final: final call (so print a goodbye messge).
             string = string+'s'
         return string
 
-    def select_tests(stat_key, tests, statuses):
-        '''Select a subset of tests.
-
-        (test.name, test.path) is included if the test object contains at least
-        one test of the desired status (stat_key).'''
-        test_subset = [(test.name, test.path) for (test, status)
-                               in zip(tests, statuses) if status[stat_key] != 0]
-        return sorted(test_subset)
-
     def format_test_subset(subset):
-        '''Format each entry in the list returned by select_tests.'''
+        '''Format each (test.name, test.path) entry in (sorted) subset.'''
         subset_fmt = []
-        for (name, path) in subset:
+        for (name, path) in sorted(subset):
             if os.path.abspath(name) == os.path.abspath(path):
                 entry = name
             else:
@@ -688,16 +826,27 @@ final: final call (so print a goodbye messge).
                 subset_fmt.append(entry)
         return subset_fmt
 
-    statuses = [test.get_status() for test in tests]
-    npassed = sum(status['passed'] for status in statuses)
-    nwarning = sum(status['warning'] for status in statuses)
-    nfailed = sum(status['failed'] for status in statuses)
-    nunknown = sum(status['unknown'] for status in statuses)
-    nskipped = sum(status['skipped'] for status in statuses)
-    nran = sum(status['ran'] for status in statuses)
-    failures = format_test_subset(select_tests('failed', tests, statuses))
-    warnings = format_test_subset(select_tests('warning', tests, statuses))
-    skipped = format_test_subset(select_tests('skipped', tests, statuses))
+    # Count the jobs with each status and find the tests which contain at
+    # least one failed, warning or skipped job in a single pass.
+    totals = dict.fromkeys(('passed', 'warning', 'failed', 'unknown',
+                            'skipped', 'ran'), 0)
+    subsets = {'failed': [], 'warning': [], 'skipped': []}
+    for test in tests:
+        status = test.get_status()
+        for key in totals:
+            totals[key] += status[key]
+        for key in subsets:
+            if status[key] != 0:
+                subsets[key].append((test.name, test.path))
+    npassed = totals['passed']
+    nwarning = totals['warning']
+    nfailed = totals['failed']
+    nunknown = totals['unknown']
+    nskipped = totals['skipped']
+    nran = totals['ran']
+    failures = format_test_subset(subsets['failed'])
+    warnings = format_test_subset(subsets['warning'])
+    skipped = format_test_subset(subsets['skipped'])
     # Treat warnings as passes but add a note about how many warnings.
     npassed += nwarning
     # Treat skipped tests as tests which weren't run.
@@ -774,6 +923,9 @@ args: command-line arguments passed to testcode2.
             options.executable, options.category, options.nprocs,
             options.benchmark, options.user_option,
             options.job_option)
+    if not options.use_caches:
+        for test_program in test_programs.values():
+            test_program.use_caches = False
 
     ret_val = 0
     if not (len(actions) == 1 and 'tidy' in actions):
@@ -786,7 +938,7 @@ args: command-line arguments passed to testcode2.
                                     options.tot_nprocs, options.first_run)
         ret_val = end_status(tests, not_checked, verbose)
     if 'compare' in actions:
-        not_checked = compare_tests(tests, verbose)
+        not_checked = compare_tests(tests, verbose, options.tot_nprocs)
         ret_val = end_status(tests, not_checked, verbose)
     if 'diff' in actions:
         diff_tests(tests, user_options['diff'], verbose)
@@ -794,7 +946,7 @@ args: command-line arguments passed to testcode2.
         tidy_tests(tests, options.older_than)
     if 'make-benchmarks' in actions:
         make_benchmarks(test_programs, tests, userconfig, start_time,
-                options.insert)
+                options.insert, options.tot_nprocs, options.hardlink)
 
     return ret_val
 
@@ -8,20 +8,17 @@ A framework for regression testing numerical programs.
 :license: modified BSD; see LICENSE for more details.
 '''
 
+import fnmatch
 import glob
 import os
-import pipes
-import shutil
+import re
+import shlex
+import stat
 import subprocess
 import sys
+import threading
 import warnings
 
-try:
-    import yaml
-    _HAVE_YAML = True
-except ImportError:
-    _HAVE_YAML = False
-
 try:
     import importlib
     _HAVE_IMPORTLIB_ = True
@@ -37,6 +34,24 @@ import testcode2.validation as validation
 
 DIR_LOCK = dir_lock.DirLock()
 
+# Caches stored in each test directory: the output of extraction programs (see
+# TestProgram.cache_extracts) and the jobs which passed (see
+# TestProgram.cache_passes).  Each cache is read from disk on first use and
+# held in _JSON_CACHES, keyed by the path to the cache file.
+_EXTRACT_CACHE_FILE = os.path.join('testcode_data', '.extract_cache.json')
+_PASS_CACHE_FILE = os.path.join('testcode_data', '.pass_cache.json')
+_JSON_CACHES = {}
+
+# Jobs started during the current run of the tests: {(real path to the test
+# directory, output pattern, run command): event set once the job has
+# finished}.  A job which is in more than one test (e.g. in tests which differ
+# only in their tolerances) is run once and its output checked by each test.
+_STARTED_JOBS = {}
+# Jobs in _STARTED_JOBS which the test running them failed to run: {key:
+# (test directory, status, message)}.  Tests sharing such a job report the
+# failure rather than checking output which was never produced.
+_FAILED_JOBS = {}
+
 # Do not change!  Bad things will happen...
 _FILESTEM_TUPLE = (
                     ('test', 'test.out'),
@@ -50,6 +65,78 @@ _FILESTEM_DICT = dict( _FILESTEM_TUPLE )
 # Bad things will happen if tests are run without the default FILESTEM!
 FILESTEM = dict( _FILESTEM_TUPLE )
 
+# Characters which make an output filename a (shell) pattern.
+_WILDCARDS = re.compile(r'[*?[{]')
+
+# Placeholders (tc.name) which are replaced in command templates.
+_TEMPLATE_FIELD = re.compile(
+        r'tc\.(program|input|args|output|error|nprocs|extract|test|bench|file|'
+        r'skip)')
+
+# Characters with a special meaning to the shell.  Commands containing any of
+# these (outside of the tc.name placeholders) are run via the shell; all other
+# commands are run directly, which avoids starting a shell for each command.
+_SHELL_SPECIAL = re.compile(r'[|&;<>()$`\\"\'*?[\]#~{}=]')
+# The redirection of standard output and error in the default run_cmd_template.
+_REDIRECT_OUTPUT = re.compile(r'\s*>\s*tc\.output\s+2>\s*tc\.error\s*$')
+
+def _split_args(args):
+    '''Split the string args into a list of arguments as the shell would.
+
+Returns None if args requires the shell (e.g. uses variables or wildcards).'''
+    if not args:
+        return []
+    if re.search(r'[|&;<>()$`*?[\]#~{}]', args):
+        return None
+    try:
+        return shlex.split(args)
+    except ValueError:
+        return None
+
+def _template_argv(template, fields):
+    '''Return the list of arguments to run template (a command) directly.
+
+A tc.name placeholder forming a whole word of template is replaced by the list
+of arguments in fields[name].  Returns None if template requires the shell or
+contains any other placeholders.'''
+    argv = []
+    for word in template.split():
+        match = _TEMPLATE_FIELD.match(word)
+        if (match and match.end() == len(word) and
+                fields.get(match.group(1)) is not None):
+            argv.extend(fields[match.group(1)])
+        elif _SHELL_SPECIAL.search(word) or _TEMPLATE_FIELD.search(word):
+            return None
+        else:
+            argv.append(word)
+    if not argv:
+        return None
+    return argv
+
+# The same filenames are quoted repeatedly (e.g. when running, skipping and
+# checking each job), so cache the results.
+_quote = compat.lru_cache(maxsize=4096)(compat.quote)
+
+@compat.lru_cache(maxsize=None)
+def _compile_template(template):
+    '''Split template into literal text and tc.name placeholders.
+
+Returns a tuple in which the even elements are literal text and the odd
+elements are the names of the placeholders.  Only a handful of templates are
+used, so each is only split once and the result reused.'''
+    return tuple(_TEMPLATE_FIELD.split(template))
+
+def _substitute_fields(template, fields):
+    '''Replace each tc.name placeholder in template with fields[name].
+
+Placeholders not in fields are left unchanged.  All placeholders are replaced in
+a single pass, so placeholders contained in the replacements are not themselves
+replaced.'''
+    parts = list(_compile_template(template))
+    for ind in range(1, len(parts), 2):
+        parts[ind] = fields.get(parts[ind], 'tc.%s' % (parts[ind],))
+    return ''.join(parts)
+
 class TestProgram:
     '''Store and access information about the program being tested.'''
     def __init__(self, name, exe, test_id, benchmark, **kwargs):
@@ -65,6 +152,11 @@ class TestProgram:
                                                     'tc.output 2> tc.error')
         self.launch_parallel = 'mpirun -np tc.nprocs'
         self.submit_pattern = 'testcode.run_cmd'
+        # Number of tests to submit to a queueing system in a single job.
+        self.submit_batch_size = 1
+        # Submit the jobs in a test (or batch of tests) to a queueing system
+        # as a job array rather than running them one after another?
+        self.submit_array = False
 
         # dummy job with default settings (e.g tolerance)
         self.default_test_settings = None
@@ -82,14 +174,47 @@ class TestProgram:
         self.skip_args = ''
         self.verify = False
         self.extract_fn = None
+        # Reuse the output of extract_program if the file it is run on is
+        # unchanged?
+        self.cache_extracts = False
+        # Reuse passes from previous runs if nothing has changed?
+        self.cache_passes = False
+        # Look up results in the above caches?  If false, the caches are still
+        # updated but all jobs are rerun and all outputs analysed (e.g. to
+        # force a rerun of the tests).
+        self.use_caches = True
+        # Run a single instance of extract_program for all files?  See
+        # extract_via_server.
+        self.extract_server_mode = False
+        self.extract_server_template = 'tc.extract tc.args'
+        self._extract_server = None
 
         # Info
         self.vcs = None
 
+        # Cache of test output, error and benchmark filenames; see
+        # _testcode_file.
+        self._testcode_files = {}
+
         # Set values passed in as keyword options.
         for (attr, val) in kwargs.items():
             setattr(self, attr, val)
 
+        # Only one file can be sent to the extraction server at a time.
+        self._extract_server_lock = dir_lock.DirLock()
+        self.extract_via_server = self._extract_server_lock.with_lock(
+                                                    self._extract_via_server)
+
+        # The programs used are the same for every job, so only need to be
+        # escaped for passing to the shell once.
+        self._quoted_exe = compat.quote(self.exe)
+        self._quoted_extract_program = None
+        if self.extract_program:
+            self._quoted_extract_program = compat.quote(self.extract_program)
+        self._quoted_skip_program = None
+        if self.skip_program:
+            self._quoted_skip_program = compat.quote(self.skip_program)
+
         # If using an external verification program, then set the default
         # extract command template.
         if self.verify and 'extract_cmd_template' not in kwargs:
@@ -112,71 +237,209 @@ class TestProgram:
                               'no data extraction program supplied.')
 
         # Can we actually extract the data?
-        if self.extract_fmt == 'yaml' and not _HAVE_YAML:
+        # PyYAML is comparatively slow to import, so only check it is
+        # available here and import it in extract_data when it is used.
+        if self.extract_fmt == 'yaml' and not compat.module_available('yaml'):
             err = 'YAML data format cannot be used: PyYAML is not installed.'
             raise exceptions.TestCodeError(err)
 
-    def run_cmd(self, input_file, args, nprocs=0):
-        '''Create run command.'''
-        output_file = util.testcode_filename(FILESTEM['test'], self.test_id,
-                input_file, args)
-        error_file = util.testcode_filename(FILESTEM['error'], self.test_id,
-                input_file, args)
+        # The caches are stored using json (python 2.6 onwards).
+        if (self.cache_extracts or self.cache_passes) and compat.json is None:
+            err = ('cache_extracts and cache_passes require python 2.6 or '
+                   'later.')
+            raise exceptions.TestCodeError(err)
+
+    def test_file(self, input_file, args):
+        '''Get the name of the test output file for a given input and arguments.
+
+The filename is only constructed once for each set of input file and arguments
+and reused subsequently.'''
+        return self._testcode_file(FILESTEM['test'], self.test_id, input_file,
+                                   args)
+
+    def error_file(self, input_file, args):
+        '''Get the name of the test error file for a given input and arguments.
+
+The filename is only constructed once for each set of input file and arguments
+and reused subsequently.'''
+        return self._testcode_file(FILESTEM['error'], self.test_id,
+                                   input_file, args)
+
+    def _testcode_file(self, stem, file_id, input_file, args):
+        '''Get the name of a testcode file (see util.testcode_filename).
+
+The filename is only constructed once and reused subsequently.'''
+        key = (stem, file_id, input_file, args)
+        if key not in self._testcode_files:
+            self._testcode_files[key] = util.testcode_filename(*key)
+        return self._testcode_files[key]
+
+    def run_cmd(self, input_file, args, nprocs=0, output_file=None,
+                error_file=None):
+        '''Create run command.
+
+The names of the output and error files are constructed from input_file and
+args unless given (e.g. if the caller already has them to hand).'''
+        if output_file is None:
+            output_file = self.test_file(input_file, args)
+        if error_file is None:
+            error_file = self.error_file(input_file, args)
 
         # Need to escape filenames for passing them to the shell.
-        exe = pipes.quote(self.exe)
-        output_file = pipes.quote(output_file)
-        error_file = pipes.quote(error_file)
+        output_file = _quote(output_file)
+        error_file = _quote(error_file)
 
-        cmd = self.run_cmd_template.replace('tc.program', exe)
+        fields = dict(program=self._quoted_exe, output=output_file,
+                      error=error_file, nprocs=str(nprocs))
         if type(input_file) is str:
-            input_file = pipes.quote(input_file)
-            cmd = cmd.replace('tc.input', input_file)
+            fields['input'] = _quote(input_file)
         else:
-            cmd = cmd.replace('tc.input', '')
+            fields['input'] = ''
         if type(args) is str:
-            cmd = cmd.replace('tc.args', args)
+            fields['args'] = args
         else:
-            cmd = cmd.replace('tc.args', '')
-        cmd = cmd.replace('tc.output', output_file)
-        cmd = cmd.replace('tc.error', error_file)
+            fields['args'] = ''
+        cmd = self.run_cmd_template
         if nprocs > 0 and self.launch_parallel:
             cmd = '%s %s' % (self.launch_parallel, cmd)
-        cmd = cmd.replace('tc.nprocs', str(nprocs))
-        return cmd
+        return _substitute_fields(cmd, fields)
+
+    def run_argv(self, input_file, args, nprocs=0):
+        '''Create the arguments to run the program directly rather than via the
+shell.
+
+Returns (argv, output_file, error_file), where the program's standard output
+and error are to be written to output_file and error_file respectively, or None
+if the run command requires the shell.'''
+        cmd = self.run_cmd_template
+        if nprocs > 0 and self.launch_parallel:
+            cmd = '%s %s' % (self.launch_parallel, cmd)
+        (cmd, nredirect) = _REDIRECT_OUTPUT.subn('', cmd)
+        if nredirect != 1:
+            return None
+        fields = dict(program=[self.exe], nprocs=[str(nprocs)], input=[],
+                      args=[])
+        if type(input_file) is str:
+            fields['input'] = [input_file]
+        if type(args) is str:
+            fields['args'] = _split_args(args)
+        argv = _template_argv(cmd, fields)
+        if argv is None:
+            return None
+        output_file = self.test_file(input_file, args)
+        error_file = self.error_file(input_file, args)
+        return (argv, output_file, error_file)
+
+    def extract_argv(self, data_file):
+        '''Create the arguments to run the extraction program on data_file
+directly rather than via the shell.
+
+Returns None if the extraction command requires the shell.'''
+        fields = dict(extract=[self.extract_program],
+                      args=_split_args(self.extract_args), file=[data_file])
+        return _template_argv(self.extract_cmd_template, fields)
+
+    def verify_argv(self, path, input_file, args):
+        '''Create the arguments to run the verification program directly
+rather than via the shell.
+
+Returns None if the verification command requires the shell.'''
+        test_file = self.test_file(input_file, args)
+        bench_file = self.select_benchmark_file(path, input_file, args)
+        fields = dict(extract=[self.extract_program],
+                      args=_split_args(self.extract_args), test=[test_file],
+                      bench=[bench_file])
+        return _template_argv(self.extract_cmd_template, fields)
 
     def extract_cmd(self, path, input_file, args):
         '''Create extraction command(s).'''
-        test_file = util.testcode_filename(FILESTEM['test'], self.test_id,
-                input_file, args)
+        test_file = self.test_file(input_file, args)
         bench_file = self.select_benchmark_file(path, input_file, args)
-        cmd = self.extract_cmd_template
-        cmd = cmd.replace('tc.extract', pipes.quote(self.extract_program))
-        cmd = cmd.replace('tc.args', self.extract_args)
+        fields = dict(extract=self._quoted_extract_program,
+                      args=self.extract_args)
         if self.verify:
             # Single command to compare benchmark and test outputs.
-            cmd = cmd.replace('tc.test', pipes.quote(test_file))
-            cmd = cmd.replace('tc.bench', pipes.quote(bench_file))
-            return (cmd,)
+            fields['test'] = _quote(test_file)
+            fields['bench'] = _quote(bench_file)
+            return (_substitute_fields(self.extract_cmd_template, fields),)
         else:
             # Need to return commands to extract data from the test and
             # benchmark outputs.
-            test_cmd = cmd.replace('tc.file', pipes.quote(test_file))
-            bench_cmd = cmd.replace('tc.file', pipes.quote(bench_file))
+            fields['file'] = _quote(test_file)
+            test_cmd = _substitute_fields(self.extract_cmd_template, fields)
+            fields['file'] = _quote(bench_file)
+            bench_cmd = _substitute_fields(self.extract_cmd_template, fields)
             return (bench_cmd, test_cmd)
 
+    def _extract_via_server(self, data_file):
+        '''Extract data from data_file using a persistent extraction program.
+Requires self._extract_server_lock.
+
+The extraction program (started using extract_server_template the first time
+this is called) is sent the path to data_file on a single line of its standard
+input and must print the extracted data followed by a line containing only
+--END-- to its standard output.  Returns the extracted data as a string.
+
+This avoids starting a new process (and shell) for every file.
+
+IMPORTANT: use self.extract_via_server rather than self._extract_via_server if
+using multiple threads.
+
+Decorated to extract_via_server, which acquires self._extract_server_lock,
+during initialisation.
+'''
+        if self._extract_server is None:
+            fields = dict(extract=self._quoted_extract_program,
+                          args=self.extract_args)
+            cmd = _substitute_fields(self.extract_server_template, fields)
+            try:
+                # Output is read a line at a time, so the pipes must be
+                # buffered (the default in python 3 but not python 2).
+                self._extract_server = subprocess.Popen(cmd, shell=True,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                        bufsize=-1)
+            except OSError:
+                err = ('Starting extraction server failed: %s'
+                           % (sys.exc_info()[1],))
+                raise exceptions.AnalysisError(err)
+        server = self._extract_server
+        data = []
+        try:
+            server.stdin.write(('%s\n' % (data_file,)).encode('utf-8'))
+            server.stdin.flush()
+            line = server.stdout.readline().decode('utf-8')
+            while line and line.rstrip('\r\n') != '--END--':
+                data.append(line)
+                line = server.stdout.readline().decode('utf-8')
+        except (IOError, OSError):
+            line = ''
+        if not line:
+            # Server has died.  Start a new one next time.
+            self._extract_server = None
+            err = ('Analysing output failed: extraction server exited before '
+                   'returning data for %s.' % (data_file,))
+            raise exceptions.AnalysisError(err)
+        return ''.join(data)
+
     def skip_cmd(self, input_file, args):
         '''Create skip command.'''
-        test_file = util.testcode_filename(FILESTEM['test'], self.test_id,
-                input_file, args)
-        error_file = util.testcode_filename(FILESTEM['error'], self.test_id,
-                input_file, args)
-        cmd = self.skip_cmd_template
-        cmd = cmd.replace('tc.skip', pipes.quote(self.skip_program))
-        cmd = cmd.replace('tc.args', self.skip_args)
-        cmd = cmd.replace('tc.test', pipes.quote(test_file))
-        cmd = cmd.replace('tc.error', pipes.quote(error_file))
-        return cmd
+        test_file = self.test_file(input_file, args)
+        error_file = self.error_file(input_file, args)
+        fields = dict(skip=self._quoted_skip_program, args=self.skip_args,
+                      test=_quote(test_file),
+                      error=_quote(error_file))
+        return _substitute_fields(self.skip_cmd_template, fields)
+
+    def skip_argv(self, input_file, args):
+        '''Create the arguments to run the skip program directly rather than
+via the shell.
+
+Returns None if the skip command requires the shell.'''
+        fields = dict(skip=[self.skip_program],
+                      args=_split_args(self.skip_args),
+                      test=[self.test_file(input_file, args)],
+                      error=[self.error_file(input_file, args)])
+        return _template_argv(self.skip_cmd_template, fields)
 
     def select_benchmark_file(self, path, input_file, args):
         '''Find the first benchmark file out of all benchmark IDs which exists.'''
@@ -184,8 +447,8 @@ class TestProgram:
         benchmark = None
         benchmarks = []
         for bench_id in self.benchmark:
-            benchfile = util.testcode_filename(FILESTEM['benchmark'], bench_id,
-                    input_file, args)
+            benchfile = self._testcode_file(FILESTEM['benchmark'], bench_id,
+                                            input_file, args)
             benchmarks.append(benchfile)
             if os.path.exists(os.path.join(path, benchfile)):
                 benchmark = benchfile
@@ -229,21 +492,51 @@ class Test:
         if not self.inputs_args:
             self.inputs_args = [('', '')]
 
-        self.status = dict( (inp_arg, None) for inp_arg in self.inputs_args )
+        # Resolve the tolerance for each data item once rather than on every
+        # comparison.
+        self.get_tolerance = validation.compile_tolerances(
+                self.default_tolerance, self.tolerances)
+
+        self.status = dict.fromkeys(self.inputs_args)
+        # Commands used to run each job; see job_cmd.
+        self._job_cmds = {}
+        # Jobs which could not be run: {(input, args): (status, message)}.
+        # See fail_test and release_jobs.
+        self._failed_jobs = {}
+        # Summary of self.status; set by get_status and reset whenever
+        # self.status is updated.
+        self._status_summary = None
 
         # 'Decorate' functions which require a directory lock in order for file
         # access to be thread-safe.
-        # As we use the in_dir decorator, which requires knowledge of the test
-        # directory (a per-instance property), we cannot use the @decorator
-        # syntactic sugar.  Fortunately we can still modify them at
-        # initialisation time.  Thank you python for closures!
-        self.start_job = DIR_LOCK.in_dir(self.path)(self._start_job)
-        self.move_output_to_test_output = DIR_LOCK.in_dir(self.path)(
+        # As the lock depends upon the test directory (a per-instance
+        # property), we cannot use the @decorator syntactic sugar.
+        # Fortunately we can still modify them at initialisation time.  Thank
+        # you python for closures!
+        # Running, skipping, verifying and submitting jobs do not change
+        # directory (subprocesses are started in self.path instead) and so do
+        # not hold a lock for their duration.
+        # Moving output files, creating benchmarks and accessing the caches of
+        # extracted data and passed jobs only require exclusive access to
+        # self.path, so use a lock which (unlike DIR_LOCK) is not shared with
+        # tests in other directories.
+        # (self.path is None for the default test settings of a program.)
+        self.dir_lock = dir_lock.get_dir_lock(self.path)
+        self.move_output_to_test_output = self.dir_lock.with_lock(
                                                self._move_output_to_test_output)
-        self.move_old_output_files = DIR_LOCK.in_dir(self.path)(
+        self.move_old_output_files = self.dir_lock.with_lock(
                                                self._move_old_output_files)
-        self.verify_job = DIR_LOCK.in_dir(self.path)(self._verify_job)
-        self.skip_job = DIR_LOCK.in_dir(self.path)(self._skip_job)
+        self.create_new_benchmarks = self.dir_lock.with_lock(
+                                               self._create_new_benchmarks)
+        self.read_pass_cache = self.dir_lock.with_lock(self._read_pass_cache)
+        self.record_pass = self.dir_lock.with_lock(self._record_pass)
+        self.lookup_extract_cache = self.dir_lock.with_lock(
+                                               self._lookup_extract_cache)
+        self.update_extract_cache = self.dir_lock.with_lock(
+                                               self._update_extract_cache)
+        self.claim_jobs = self.dir_lock.with_lock(self._claim_jobs)
+        # print_job_status uses DIR_LOCK, which is shared by all tests, and so
+        # is decorated once in the class rather than for each test.
 
     def __hash__(self):
         return hash(self.path)
@@ -262,19 +555,35 @@ class Test:
     def run_test(self, verbose=1, cluster_queue=None, rundir=None):
         '''Run all jobs in test.'''
 
+        (inputs_args, pass_keys, shared_jobs) = self.jobs_to_run(verbose,
+                                                                 rundir)
+        try:
+            self.run_jobs(inputs_args, pass_keys, verbose, cluster_queue,
+                          rundir)
+        finally:
+            self.release_jobs(inputs_args)
+        self.verify_shared_jobs(shared_jobs, pass_keys, verbose, rundir)
+
+    def run_jobs(self, inputs_args, pass_keys, verbose=1, cluster_queue=None,
+                 rundir=None):
+        '''Run the jobs given by inputs_args.
+
+inputs_args, pass_keys: as returned by jobs_to_run.
+verbose, cluster_queue, rundir: as for run_test.'''
+
         try:
+            if not inputs_args:
+                return
+
             # Construct tests.
-            test_cmds = []
-            test_files = []
-            for (test_input, test_arg) in self.inputs_args:
-                if (test_input and
-                        not os.path.exists(os.path.join(self.path,test_input))):
-                    err = 'Input file does not exist: %s' % (test_input,)
-                    raise exceptions.RunError(err)
-                test_cmds.append(self.test_program.run_cmd(test_input, test_arg,
-                                                           self.nprocs))
-                test_files.append(util.testcode_filename(FILESTEM['test'],
-                        self.test_program.test_id, test_input, test_arg))
+            # Jobs often share an input file (with different arguments), so
+            # only check each input file once.
+            checked = compat.compat_set()
+            for (test_input, test_arg) in inputs_args:
+                if test_input not in checked:
+                    self.check_input(test_input)
+                    checked.add(test_input)
+            (test_cmds, test_files) = self.job_cmds(inputs_args)
 
             # Move files matching output pattern out of the way.
             self.move_old_output_files(verbose)
@@ -282,28 +591,32 @@ class Test:
             # Run tests one-at-a-time locally or submit job in single submit
             # file to a queueing system.
             if cluster_queue:
-                if self.output:
-                    for (ind, test) in enumerate(test_cmds):
-                        # Don't quote self.output if it contains any wildcards
-                        # (assume the user set it up correctly!)
-                        out = self.output
-                        if not compat.compat_any(wild in self.output for wild in
-                                ['*', '?', '[', '{']):
-                            out = pipes.quote(self.output)
-                        test_cmds[ind] = '%s; mv %s %s' % (test_cmds[ind],
-                                out, pipes.quote(test_files[ind]))
-                test_cmds = ['\n'.join(test_cmds)]
-            for (ind, test) in enumerate(test_cmds):
-                job = self.start_job(test, cluster_queue, verbose)
-                job.wait()
-                # Analyse tests as they finish.
-                if cluster_queue:
-                    # Did all of them at once.
-                    for (test_input, test_arg) in self.inputs_args:
-                        self.verify_job(test_input, test_arg, verbose, rundir)
+                if self.array_jobs() and len(test_cmds) > 1:
+                    cmd = self.cluster_job_cmds(test_cmds, test_files)
                 else:
-                    # Did one job at a time.
-                    (test_input, test_arg) = self.inputs_args[ind]
+                    cmd = self.cluster_cmd(test_cmds, test_files)
+                job = self.start_job(cmd, cluster_queue, verbose)
+                job.wait()
+                # Did all of them at once.
+                for (test_input, test_arg) in inputs_args:
+                    self.verify_run_job(test_input, test_arg,
+                            pass_keys.get((test_input, test_arg)), verbose,
+                            rundir)
+                sys.stdout.flush()
+            else:
+                # Did one job at a time.  Jobs are run consecutively (the user
+                # can set run_concurrent otherwise) but each job is compared
+                # against its benchmark while the next job is running.
+                # Run the program directly rather than via the shell where
+                # possible.
+                test_argvs = [self.test_program.run_argv(test_input, test_arg,
+                                                         self.nprocs)
+                              for (test_input, test_arg) in inputs_args]
+                job = self.start_job(test_cmds[0], cluster_queue, verbose,
+                                     test_argvs[0])
+                for ind in range(len(test_cmds)):
+                    (test_input, test_arg) = inputs_args[ind]
+                    job.wait()
                     err = []
                     if self.output:
                         try:
@@ -318,74 +631,267 @@ class Test:
                                                       verbose)
                     if status.skipped():
                         self._update_status(status, (test_input, test_arg))
-                        if verbose > 0 and verbose < 3:
-                            sys.stdout.write(
-                                    util.info_line(self.path,
-                                                   test_input, test_arg, rundir)
-                                            )
-                        status.print_status(msg, verbose)
+                        self.print_job_status(status, msg, test_input,
+                                              test_arg, verbose, rundir)
                     elif err:
                         # re-raise first error we hit.
                         raise exceptions.RunError(err[0])
-                    else:
-                        self.verify_job(test_input, test_arg, verbose, rundir)
-                sys.stdout.flush()
+                    # The output of this job has been moved out of the way, so
+                    # the next job can be started.
+                    next_job_err = None
+                    if ind+1 < len(test_cmds):
+                        try:
+                            job = self.start_job(test_cmds[ind+1],
+                                                 cluster_queue, verbose,
+                                                 test_argvs[ind+1])
+                        except exceptions.RunError:
+                            next_job_err = sys.exc_info()[1]
+                    if not status.skipped():
+                        self.verify_run_job(test_input, test_arg,
+                                pass_keys.get((test_input, test_arg)), verbose,
+                                rundir)
+                    sys.stdout.flush()
+                    if next_job_err:
+                        (test_input, test_arg) = inputs_args[ind+1]
+                        raise next_job_err
         except exceptions.RunError:
-            err = sys.exc_info()[1]
-            if verbose > 2:
-                err = 'Test(s) in %s failed.\n%s' % (self.path, err)
-            status = validation.Status([False])
-            self._update_status(status, (test_input, test_arg))
-            if verbose > 0 and verbose < 3:
-                info_line = util.info_line(self.path, test_input, test_arg, rundir)
-                sys.stdout.write(info_line)
-            status.print_status(err, verbose)
-            # Shouldn't run remaining tests after such a catastrophic failure.
-            # Mark all remaining tests as skipped so the user knows that they
-            # weren't run.
-            err = 'Previous test in %s caused a system failure.' % (self.path)
-            status = validation.Status(name='skipped')
-            for ((test_input, test_arg), stat) in self.status.items():
-                if not self.status[(test_input,test_arg)]:
-                    self._update_status(status, (test_input, test_arg))
-                    if verbose > 2:
-                        cmd = self.test_program.run_cmd(test_input, test_arg,
-                                                        self.nprocs)
-                        print('Test using %s in %s' % (cmd, self.path))
-                    elif verbose > 0:
-                        info_line = util.info_line(self.path, test_input,
-                                                   test_arg, rundir)
-                        sys.stdout.write(info_line)
-                    status.print_status(err, verbose)
-                sys.stdout.flush()
+            self.fail_test(sys.exc_info()[1], test_input, test_arg, verbose,
+                           rundir, inputs_args)
+
+    def jobs_to_run(self, verbose=1, rundir=None):
+        '''Return the (input file, arguments) of the jobs in the test which need
+to be run, a dictionary of the corresponding keys given by _pass_key and the
+jobs which are instead run by other tests (see claim_jobs).
+
+If TestProgram.cache_passes is set, jobs which passed previously and whose
+inputs are unchanged are not rerun (see reuse_passes).
+
+The jobs returned are claimed by this test and must be released (see
+release_jobs) once they have been run.'''
+        if self.test_program.cache_passes:
+            pass_keys = self.reuse_passes(verbose, rundir)
+            inputs_args = [inp_arg for inp_arg in self.inputs_args
+                               if inp_arg in pass_keys]
+        else:
+            (inputs_args, pass_keys) = (self.inputs_args, {})
+        (inputs_args, shared_jobs) = self.claim_jobs(inputs_args)
+        return (inputs_args, pass_keys, shared_jobs)
+
+    def _job_key(self, input_file, args):
+        '''Return the key identifying a job in _STARTED_JOBS.'''
+        # The directory lock is the same for all paths to the test directory.
+        return (self.dir_lock, self.output, self.job_cmd(input_file, args))
 
-    def _start_job(self, cmd, cluster_queue=None, verbose=1):
-        '''Start test running.  Requires directory lock.
+    def _claim_jobs(self, inputs_args):
+        '''Claim the jobs given by inputs_args which have not been started by
+another test.  Requires self.dir_lock.
 
-IMPORTANT: use self.start_job rather than self._start_job if using multiple
+IMPORTANT: use self.claim_jobs rather than self._claim_jobs if using multiple
 threads.
 
-Decorated to start_job, which acquires directory lock and enters self.path
-first, during initialisation.'''
+Decorated to claim_jobs, which acquires self.dir_lock, during initialisation.
+
+Returns the list of (input file, arguments) of the jobs claimed, which must be
+run by this test, and a list of ((input file, arguments), event) of the jobs
+started by other tests, where event is set once the job has finished.'''
+        claimed = []
+        shared = []
+        for (test_input, test_arg) in inputs_args:
+            key = self._job_key(test_input, test_arg)
+            if key in _STARTED_JOBS:
+                shared.append(((test_input, test_arg), _STARTED_JOBS[key]))
+            else:
+                _STARTED_JOBS[key] = threading.Event()
+                claimed.append((test_input, test_arg))
+        return (claimed, shared)
+
+    def release_jobs(self, inputs_args):
+        '''Mark the jobs given by inputs_args, which have been claimed by this
+test, as finished, recording any which failed to run (see fail_test) for other
+tests sharing them.'''
+        for (test_input, test_arg) in inputs_args:
+            key = self._job_key(test_input, test_arg)
+            if (test_input, test_arg) in self._failed_jobs:
+                (status, msg) = self._failed_jobs[(test_input, test_arg)]
+                _FAILED_JOBS[key] = (self.path, status, msg)
+            _STARTED_JOBS[key].set()
+        self._failed_jobs.clear()
+
+    def verify_shared_jobs(self, shared_jobs, pass_keys, verbose=1,
+                           rundir=None):
+        '''Check jobs run by other tests against the benchmark once they have
+finished.
+
+shared_jobs, pass_keys: as returned by jobs_to_run.
+verbose, rundir: as for run_test.'''
+        for ((test_input, test_arg), event) in shared_jobs:
+            event.wait()
+            key = self._job_key(test_input, test_arg)
+            if key in _FAILED_JOBS:
+                (path, status, err) = _FAILED_JOBS[key]
+                msg = 'Job shared with test in %s: %s' % (path, err)
+                self._update_status(status, (test_input, test_arg))
+                self.print_job_status(status, msg, test_input, test_arg,
+                                      verbose, rundir)
+            else:
+                self.verify_run_job(test_input, test_arg,
+                        pass_keys.get((test_input, test_arg)), verbose, rundir)
+        sys.stdout.flush()
+
+    def verify_run_job(self, input_file, args, pass_key=None, verbose=1,
+                       rundir=None):
+        '''Check a job which has just been run against its benchmark.
+
+If the job passed and pass_key (see _pass_key) is given, the pass is recorded
+so that the job need not be rerun.'''
+        (status, msg) = self.verify_job(input_file, args, verbose, rundir)
+        if status.passed() and pass_key:
+            self.record_pass(input_file, args, pass_key)
+        return (status, msg)
+
+    def check_input(self, test_input):
+        '''Raise RunError if the input file test_input does not exist.'''
+        if (test_input and
+                not os.path.exists(os.path.join(self.path, test_input))):
+            err = 'Input file does not exist: %s' % (test_input,)
+            raise exceptions.RunError(err)
+
+    def job_cmds(self, inputs_args=None):
+        '''Return the commands to run each job in the test and the names of the
+corresponding test output files.
+
+inputs_args: list of (input file, arguments) of the jobs to run.  Default: all
+    jobs in the test.'''
+        if inputs_args is None:
+            inputs_args = self.inputs_args
+        test_cmds = []
+        test_files = []
+        for (test_input, test_arg) in inputs_args:
+            test_cmds.append(self.job_cmd(test_input, test_arg))
+            test_files.append(self.test_program.test_file(test_input,
+                                                          test_arg))
+        return (test_cmds, test_files)
+
+    def job_cmd(self, input_file, args):
+        '''Return the command to run the job for input_file and args.
+
+The standard output is written to the test output file.  The command is only
+constructed once (for a given number of processors) and reused subsequently, as
+it is required both to run the job and to identify it (see claim_jobs).'''
+        key = (input_file, args, self.nprocs)
+        if key not in self._job_cmds:
+            test_file = self.test_program.test_file(input_file, args)
+            self._job_cmds[key] = self.test_program.run_cmd(input_file, args,
+                                        self.nprocs, output_file=test_file)
+        return self._job_cmds[key]
+
+    def array_jobs(self):
+        '''Return True if the jobs in the test can be submitted to a queueing
+system as a job array.
+
+Jobs which produce output in the file given by self.output cannot be run at the
+same time, as each would overwrite the output of the others.'''
+        return self.test_program.submit_array and not self.output
+
+    def cluster_cmd(self, test_cmds, test_files):
+        '''Return the command to run all jobs in the test as a single job
+submitted to a queueing system.
+
+test_cmds and test_files are as returned by job_cmds.'''
+        return '\n'.join(self.cluster_job_cmds(test_cmds, test_files))
+
+    def cluster_job_cmds(self, test_cmds, test_files):
+        '''Return the command to run each job in the test when submitted to a
+queueing system.
+
+test_cmds and test_files are as returned by job_cmds.'''
+        job_cmds = test_cmds
+        if self.output:
+            # Don't quote self.output if it contains any wildcards
+            # (assume the user set it up correctly!)
+            out = self.output
+            if not _WILDCARDS.search(self.output):
+                out = compat.quote(self.output)
+            mv_cmd = '; mv %s ' % (out,)
+            job_cmds = [test_cmd + mv_cmd + _quote(test_file)
+                for (test_cmd, test_file) in zip(test_cmds, test_files)]
+        return job_cmds
+
+    def fail_test(self, err, test_input, test_arg, verbose=1, rundir=None,
+                  inputs_args=None):
+        '''Record and print a failure to run the job for test_input and
+test_arg and mark all remaining jobs in inputs_args as skipped.
+
+inputs_args: the jobs claimed by this test (see jobs_to_run).  Jobs shared with
+    other tests are checked once the test running them has finished (see
+    verify_shared_jobs) and so are not skipped.  Default: all jobs in the
+    test.'''
+        if inputs_args is None:
+            inputs_args = self.inputs_args
+        if verbose > 2:
+            err = 'Test(s) in %s failed.\n%s' % (self.path, err)
+        status = validation.Status([False])
+        self._update_status(status, (test_input, test_arg))
+        self._failed_jobs[(test_input, test_arg)] = (status, err)
+        self.print_job_status(status, err, test_input, test_arg, verbose,
+                              rundir)
+        # Shouldn't run remaining tests after such a catastrophic failure.
+        # Mark all remaining tests as skipped so the user knows that they
+        # weren't run.
+        err = 'Previous test in %s caused a system failure.' % (self.path)
+        status = validation.Status(name='skipped')
+        for (test_input, test_arg) in inputs_args:
+            if not self.status[(test_input,test_arg)]:
+                self._update_status(status, (test_input, test_arg))
+                self._failed_jobs[(test_input, test_arg)] = (status, err)
+                if verbose > 2:
+                    cmd = self.test_program.run_cmd(test_input, test_arg,
+                                                    self.nprocs)
+                    print('Test using %s in %s' % (cmd, self.path))
+                elif verbose > 0:
+                    info_line = util.info_line(self.path, test_input,
+                                               test_arg, rundir)
+                    sys.stdout.write(info_line)
+                status.print_status(err, verbose)
+            sys.stdout.flush()
+
+    def start_job(self, cmd, cluster_queue=None, verbose=1, run_argv=None):
+        '''Start test running.
+
+Jobs run locally are started in self.path; jobs are submitted to a queueing
+system via self.submit_job.  cmd can be a list of commands when submitting to a
+queueing system, in which case they are submitted as a job array (see
+queues.ClusterQueueJob.create_submit_file).
+
+run_argv: if supplied (see TestProgram.run_argv), a job run locally is started
+    directly using run_argv rather than running cmd via the shell.'''
 
         if cluster_queue:
-            tp_ptr = self.test_program
-            submit_file = '%s.%s' % (os.path.basename(self.submit_template),
-                                                                tp_ptr.test_id)
-            job = queues.ClusterQueueJob(submit_file, system=cluster_queue)
-            job.create_submit_file(tp_ptr.submit_pattern, cmd,
-                                   self.submit_template)
-            if verbose > 2:
-                print('Submitting tests using %s (template submit file) in %s'
-                           % (self.submit_template, self.path))
-            job.start_job()
+            job = self.submit_job(cmd, cluster_queue, verbose)
         else:
             # Run locally via subprocess.
             if verbose > 2:
                 print('Running test using %s in %s\n' % (cmd, self.path))
+            # The job is started in self.path (changing directory in testcode
+            # would affect all threads), so subprocess cannot use
+            # posix_spawn.  It does, however, use vfork on Linux from python
+            # 3.10 onwards, which avoids copying the page tables of testcode.
             try:
-                job = subprocess.Popen(cmd, shell=True)
-            except OSError:
+                if run_argv:
+                    (argv, output_file, error_file) = run_argv
+                    fout = open(os.path.join(self.path, output_file), 'wb')
+                    try:
+                        ferr = open(os.path.join(self.path, error_file), 'wb')
+                        try:
+                            job = subprocess.Popen(argv, stdout=fout,
+                                                   stderr=ferr, cwd=self.path)
+                        finally:
+                            ferr.close()
+                    finally:
+                        fout.close()
+                else:
+                    job = subprocess.Popen(cmd, shell=True, cwd=self.path)
+            except (IOError, OSError):
                 # slightly odd syntax in order to be compatible with python 2.5
                 # and python 2.6/3
                 err = 'Execution of test failed: %s' % (sys.exc_info()[1],)
@@ -395,67 +901,106 @@ first, during initialisation.'''
         # a wait method which returns only once job has finished.
         return job
 
+    def submit_job(self, cmd, cluster_queue, verbose=1):
+        '''Submit test to a queueing system.
+
+The submit file is created, and the job submitted, in self.path.'''
+
+        tp_ptr = self.test_program
+        submit_file = '%s.%s' % (os.path.basename(self.submit_template),
+                                                            tp_ptr.test_id)
+        job = queues.ClusterQueueJob(submit_file, system=cluster_queue,
+                                     path=self.path)
+        job.create_submit_file(tp_ptr.submit_pattern, cmd,
+                               self.submit_template)
+        if verbose > 2:
+            print('Submitting tests using %s (template submit file) in %s'
+                       % (self.submit_template, self.path))
+        job.start_job()
+        return job
+
+    def _glob_output(self):
+        '''Return the paths to the files in self.path matching self.output.
+
+Equivalent to glob.glob(os.path.join(self.path, self.output)) except that,
+unless self.output refers to a subdirectory, self.path is scanned once and
+special characters in self.path are not treated as wildcards.'''
+        if os.path.dirname(self.output):
+            return glob.glob(os.path.join(self.path, self.output))
+        names = os.listdir(self.path)
+        if self.output[0] != '.':
+            # As for glob, wildcards don't match hidden files.
+            names = [name for name in names if name[0] != '.']
+        return [os.path.join(self.path, name)
+                    for name in fnmatch.filter(names, self.output)]
+
     def _move_output_to_test_output(self, test_files_out):
-        '''Move output to the testcode output file.  Requires directory lock.
+        '''Move output to the testcode output file (both in self.path).
+Requires self.dir_lock.
 
 This is used when a program writes to standard output rather than to STDOUT.
 
 IMPORTANT: use self.move_output_to_test_output rather than
 self._move_output_to_test_output if using multiple threads.
 
-Decorated to move_output_to_test_output, which acquires the directory lock and
-enters self.path.
+Decorated to move_output_to_test_output, which acquires self.dir_lock, during
+initialisation.
 '''
         # self.output might be a glob which works with e.g.
         #   mv self.output test_files[ind]
         # if self.output matches only one file.  Reproduce that
         # here so that running tests through the queueing system
         # and running tests locally have the same behaviour.
-        out_files = glob.glob(self.output)
+        out_files = self._glob_output()
         if len(out_files) == 1:
-            shutil.move(out_files[0], test_files_out)
+            # Both files are in self.path, so a rename is sufficient.
+            try:
+                compat.replace(out_files[0],
+                               os.path.join(self.path, test_files_out))
+            except OSError:
+                err = ('Cannot move output (%s) to %s: %s.'
+                         % (compat.relpath(out_files[0], self.path),
+                            test_files_out, sys.exc_info()[1].strerror))
+                raise exceptions.RunError(err)
         else:
+            out_files = [compat.relpath(out_file, self.path)
+                             for out_file in out_files]
             err = ('Output pattern (%s) matches %s files (%s).'
                      % (self.output, len(out_files), out_files))
             raise exceptions.RunError(err)
 
     def _move_old_output_files(self, verbose=1):
-        '''Move output to the testcode output file.  Requires directory lock.
+        '''Move existing files in self.path matching the output pattern out of
+the way.  Requires self.dir_lock.
 
 This is used when a program writes to standard output rather than to STDOUT.
 
-IMPORTANT: use self.move_oold_output_files rather than
+IMPORTANT: use self.move_old_output_files rather than
 self._move_old_output_files if using multiple threads.
 
-Decorated to move_old_output_files, which acquires the directory lock and
-enters self.path.
+Decorated to move_old_output_files, which acquires self.dir_lock, during
+initialisation.
 '''
         if self.output:
-            old_out_files = glob.glob(self.output)
+            old_out_files = self._glob_output()
             if old_out_files:
                 out_dir = 'test.prev.output.%s' % (self.test_program.test_id)
                 if verbose > 2:
                     print('WARNING: found existing files matching output '
                           'pattern: %s.' % self.output)
                     print('WARNING: moving existing output files (%s) to %s.\n'
-                          % (', '.join(old_out_files), out_dir))
+                          % (', '.join(compat.relpath(out_file, self.path)
+                                 for out_file in old_out_files), out_dir))
+                out_dir = os.path.join(self.path, out_dir)
                 if not os.path.exists(out_dir):
                     os.mkdir(out_dir)
                 for out_file in old_out_files:
-                    shutil.move(out_file, out_dir)
-
-    def _verify_job(self, input_file, args, verbose=1, rundir=None):
-        '''Check job against benchmark.
-
-Assume function is executed in self.path.
-
-IMPORTANT: use self.verify_job rather than self._verify_job if using multiple
-threads.
+                    util.move_file(out_file, os.path.join(out_dir,
+                                                os.path.basename(out_file)))
 
-Decorated to verify_job, which acquires directory lock and enters self.path
-first, during initialisation.'''
-        # We already have DIR_LOCK, so use _skip_job instead of skip_job.
-        (status, msg) = self._skip_job(input_file, args, verbose)
+    def verify_job(self, input_file, args, verbose=1, rundir=None):
+        '''Check job against benchmark.'''
+        (status, msg) = self.skip_job(input_file, args, verbose)
         try:
             if self.test_program.verify and not status.skipped():
                 (status, msg) = self.verify_job_external(input_file, args,
@@ -465,7 +1010,7 @@ first, during initialisation.'''
                                                           verbose)
                 (comparable, status, msg) = validation.compare_data(bench_out,
                         test_out, self.default_tolerance, self.tolerances,
-                        self.test_program.ignore_fields)
+                        self.test_program.ignore_fields, self.get_tolerance)
                 if verbose > 2:
                     # Include data tables in output.
                     if comparable:
@@ -493,21 +1038,31 @@ first, during initialisation.'''
             status = validation.Status([False])
 
         self._update_status(status, (input_file, args))
+        self.print_job_status(status, msg, input_file, args, verbose, rundir)
+
+        return (status, msg)
+
+    def _print_job_status(self, status, msg, input_file, args, verbose=1,
+                          rundir=None):
+        '''Print the status of a job.  Requires directory lock.
+
+IMPORTANT: use self.print_job_status rather than self._print_job_status if
+using multiple threads.
+
+Decorated to print_job_status, which acquires the directory lock.'''
         if verbose > 0 and verbose < 3:
             info_line = util.info_line(self.path, input_file, args, rundir)
             sys.stdout.write(info_line)
         status.print_status(msg, verbose)
+        sys.stdout.flush()
 
-        return (status, msg)
-
-    def _skip_job(self, input_file, args, verbose=1):
-        '''Run user-supplied command to check if test should be skipped.
+    # Printing the status of a job takes several writes to stdout: hold the
+    # lock so output from different threads is not interleaved.
+    print_job_status = DIR_LOCK.with_lock(_print_job_status)
 
-IMPORTANT: use self.skip_job rather than self._skip_job if using multiple
-threads.
-
-Decorated to skip_job, which acquires directory lock and enters self.path
-first, during initialisation.'''
+    def skip_job(self, input_file, args, verbose=1):
+        '''Run user-supplied command (in self.path) to check if test should be
+skipped.'''
         status = validation.Status()
         if self.test_program.skip_program:
             cmd = self.test_program.skip_cmd(input_file, args)
@@ -515,9 +1070,22 @@ first, during initialisation.'''
                 if verbose > 2:
                     print('Testing whether to skip test using %s in %s.' %
                             (cmd, self.path))
-                skip_popen = subprocess.Popen(cmd, shell=True,
-                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                skip_popen.wait()
+                # Only the exit status is used, so discard the output rather
+                # than reading it.
+                devnull = open(os.devnull, 'wb')
+                try:
+                    # Run the skip program directly rather than via the shell
+                    # where possible.
+                    argv = self.test_program.skip_argv(input_file, args)
+                    if argv:
+                        skip_popen = subprocess.Popen(argv, stdout=devnull,
+                                stderr=devnull, cwd=self.path)
+                    else:
+                        skip_popen = subprocess.Popen(cmd, shell=True,
+                                stdout=devnull, stderr=devnull, cwd=self.path)
+                    skip_popen.wait()
+                finally:
+                    devnull.close()
                 if skip_popen.returncode == 0:
                     # skip this test
                     status = validation.Status(name='skipped')
@@ -529,17 +1097,30 @@ first, during initialisation.'''
         return (status, '')
 
     def verify_job_external(self, input_file, args, verbose=1):
-        '''Run user-supplied verifier script.
-
-Assume function is executed in self.path.'''
+        '''Run user-supplied verifier script in self.path.'''
         verify_cmd, = self.test_program.extract_cmd(self.path, input_file, args)
         try:
             if verbose > 2:
                 print('Analysing test using %s in %s.' %
                         (verify_cmd, self.path))
-            verify_popen = subprocess.Popen(verify_cmd, shell=True,
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            verify_popen.wait()
+            # The error output is not used, so discard it rather than
+            # reading it.
+            devnull = open(os.devnull, 'wb')
+            try:
+                # Run the verification program directly rather than via the
+                # shell where possible.
+                argv = self.test_program.verify_argv(self.path, input_file,
+                                                     args)
+                if argv:
+                    verify_popen = subprocess.Popen(argv,
+                            stdout=subprocess.PIPE, stderr=devnull,
+                            cwd=self.path)
+                else:
+                    verify_popen = subprocess.Popen(verify_cmd, shell=True,
+                            stdout=subprocess.PIPE, stderr=devnull,
+                            cwd=self.path)
+            finally:
+                devnull.close()
         except OSError:
             # slightly odd syntax in order to be compatible with python 2.5
             # and python 2.6/3
@@ -555,63 +1136,129 @@ Assume function is executed in self.path.'''
             return (validation.Status([False]), output)
 
     def extract_data(self, input_file, args, verbose=1):
-        '''Extract data from output file.
-
-Assume function is executed in self.path.'''
+        '''Extract data from the benchmark and test output files in self.path.'''
         tp_ptr = self.test_program
         data_files = [
                       tp_ptr.select_benchmark_file(self.path, input_file, args),
-                      util.testcode_filename(FILESTEM['test'],
-                      tp_ptr.test_id, input_file, args),
+                      tp_ptr.test_file(input_file, args),
                      ]
         if tp_ptr.data_tag:
             # Using internal data extraction function.
             if verbose > 2:
                 print('Analysing output using data_tag %s in %s on files %s.' %
                         (tp_ptr.data_tag, self.path, ' and '.join(data_files)))
-            outputs = [util.extract_tagged_data(tp_ptr.data_tag, dfile)
+            outputs = [util.extract_tagged_data(tp_ptr.data_tag,
+                                                os.path.join(self.path, dfile))
                     for dfile in data_files]
         elif tp_ptr.extract_fn:
             if verbose > 2:
                 print('Analysing output using function %s in %s on files %s.' %
                         (tp_ptr.extract_fn.__name__, self.path,
                          ' and '.join(data_files)))
-            outputs = [tp_ptr.extract_fn(dfile) for dfile in data_files]
+            # User-supplied functions are called from within self.path, as
+            # they might open other files in the test directory.
+            extract_fn = DIR_LOCK.in_dir(self.path)(tp_ptr.extract_fn)
+            outputs = [extract_fn(dfile) for dfile in data_files]
         else:
             # Using external data extraction script.
             # Get extraction commands.
             extract_cmds = tp_ptr.extract_cmd(self.path, input_file, args)
 
+            # Reuse the output from previous extractions of unchanged files.
+            data_strings = [None for cmd in extract_cmds]
+            new_cache_entries = []
+            # The output is only cached if the extraction program can be
+            # checked for changes.
+            program_digest = None
+            if tp_ptr.cache_extracts:
+                program_digest = util.cached_file_digest(
+                                                    tp_ptr.extract_program)
+            if program_digest:
+                digests = [util.file_digest(os.path.join(self.path, dfile))
+                               for dfile in data_files]
+                if tp_ptr.use_caches:
+                    data_strings = self.lookup_extract_cache(extract_cmds,
+                                                    digests, program_digest)
+
             # Extract data.
-            outputs = []
-            for cmd in extract_cmds:
+            # Start all extraction commands (one each for the benchmark and
+            # test outputs) before waiting for any of them so that they run at
+            # the same time.
+            extract_popens = []
+            for (ind, cmd) in enumerate(extract_cmds):
+                if data_strings[ind] is not None:
+                    if verbose > 2:
+                        print('Using cached output of %s in %s.' %
+                                (cmd, self.path))
+                    extract_popens.append(None)
+                    continue
+                if tp_ptr.extract_server_mode:
+                    if verbose > 2:
+                        print('Analysing output using extraction server on %s '
+                              'in %s.' % (data_files[ind], self.path))
+                    data_strings[ind] = tp_ptr.extract_via_server(
+                                    os.path.join(self.path, data_files[ind]))
+                    extract_popens.append(None)
+                    if program_digest and digests[ind]:
+                        new_cache_entries.append((cmd, data_files[ind],
+                                digests[ind], data_strings[ind]))
+                    continue
                 try:
                     if verbose > 2:
                         print('Analysing output using %s in %s.' %
                                 (cmd, self.path))
-                    extract_popen = subprocess.Popen(cmd, shell=True,
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                    extract_popen.wait()
+                    # Run the extraction program directly rather than via
+                    # the shell where possible.
+                    argv = tp_ptr.extract_argv(data_files[ind])
+                    if argv:
+                        extract_popen = subprocess.Popen(argv,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=self.path)
+                    else:
+                        extract_popen = subprocess.Popen(cmd, shell=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                cwd=self.path)
+                    extract_popens.append(extract_popen)
                 except OSError:
                     # slightly odd syntax in order to be compatible with python
                     # 2.5 and python 2.6/3
                     err = 'Analysing output failed: %s' % (sys.exc_info()[1],)
                     raise exceptions.AnalysisError(err)
-                # Convert data string from extract command to dictionary format.
+            # communicate reads the output as it is produced (and waits for
+            # the command to finish), so commands producing a lot of output
+            # cannot block on a full pipe.
+            for (ind, extract_popen) in enumerate(extract_popens):
+                if extract_popen is None:
+                    continue
+                (data_string, err) = extract_popen.communicate()
                 if extract_popen.returncode != 0:
-                    err = extract_popen.communicate()[1].decode('utf-8')
+                    err = err.decode('utf-8')
                     err = 'Analysing output failed: %s' % (err)
                     raise exceptions.AnalysisError(err)
-                data_string = extract_popen.communicate()[0].decode('utf-8')
+                data_strings[ind] = data_string.decode('utf-8')
+                if program_digest and digests[ind]:
+                    new_cache_entries.append((extract_cmds[ind],
+                            data_files[ind], digests[ind], data_strings[ind]))
+            if new_cache_entries:
+                self.update_extract_cache(new_cache_entries, program_digest)
+
+            outputs = []
+            for data_string in data_strings:
+                # Convert data string from extract command to dictionary format.
                 if self.test_program.extract_fmt == 'table':
                     outputs.append(util.dict_table_string(data_string))
                 elif self.test_program.extract_fmt == 'yaml':
+                    import yaml
+                    # Use the (much faster) libyaml-based loader if PyYAML
+                    # was built with it.
+                    yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+                    data = yaml.load(data_string, Loader=yaml_loader)
                     outputs.append({})
                     # convert values to be in a tuple so the format matches
                     # that from dict_table_string.
                     # ensure all keys are strings so they can be sorted
                     # (different data types cause problems!)
-                    for (key, val) in yaml.safe_load(data_string).items():
+                    for (key, val) in data.items():
                         if isinstance(val, list):
                             outputs[-1][str(key)] = tuple(val)
                         else:
@@ -619,44 +1266,247 @@ Assume function is executed in self.path.'''
 
         return tuple(outputs)
 
-    def create_new_benchmarks(self, benchmark, copy_files_since=None,
-            copy_files_path='testcode_data'):
-        '''Copy the test files to benchmark files.'''
+    def _json_cache(self, cache_file):
+        '''Return the cache stored in cache_file (relative to self.path).
+Requires self.dir_lock.'''
+        cache_file = os.path.join(self.path, cache_file)
+        if cache_file not in _JSON_CACHES:
+            cache = {}
+            if os.path.exists(cache_file):
+                fcache = open(cache_file)
+                try:
+                    try:
+                        cache = compat.json.load(fcache)
+                    except ValueError:
+                        # Corrupt cache; start again.
+                        cache = {}
+                finally:
+                    fcache.close()
+            _JSON_CACHES[cache_file] = cache
+        return _JSON_CACHES[cache_file]
+
+    def _save_json_cache(self, cache_file):
+        '''Write the cache returned by self._json_cache(cache_file) to disk.
+Requires self.dir_lock.'''
+        cache = self._json_cache(cache_file)
+        cache_file = os.path.join(self.path, cache_file)
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            os.mkdir(os.path.dirname(cache_file))
+        fcache = open(cache_file, 'w')
+        try:
+            compat.json.dump(cache, fcache)
+        finally:
+            fcache.close()
+
+    def _lookup_extract_cache(self, extract_cmds, digests, program_digest):
+        '''Return the cached output of each extraction command in extract_cmds.
+Requires self.dir_lock.
+
+digests: digest of the contents of the data file each command is run on.
+program_digest: digest of the extraction program.
+
+The output of a command is None if it is not cached or the data file or
+extraction program has changed since it was cached.
+
+IMPORTANT: use self.lookup_extract_cache rather than
+self._lookup_extract_cache if using multiple threads.
+
+Decorated to lookup_extract_cache, which acquires self.dir_lock, during
+initialisation.
+'''
+        # The cache maps each extraction command to the data file it extracts
+        # data from, the digest of the data file, the output of the command and
+        # the digest of the extraction program.
+        cache = self._json_cache(_EXTRACT_CACHE_FILE)
+        data_strings = []
+        for (cmd, digest) in zip(extract_cmds, digests):
+            entry = cache.get(cmd)
+            if (digest and entry and entry[1] == digest and
+                    len(entry) > 3 and entry[3] == program_digest):
+                data_strings.append(entry[2])
+            else:
+                data_strings.append(None)
+        return data_strings
+
+    def _update_extract_cache(self, entries, program_digest):
+        '''Add entries to the cache of extraction output and save the cache.
+Requires self.dir_lock.
+
+entries: list of (extraction command, data file, digest of data file, output)
+    tuples.
+program_digest: digest of the extraction program used.
+
+Entries for data files which no longer exist are removed.
+
+IMPORTANT: use self.update_extract_cache rather than
+self._update_extract_cache if using multiple threads.
+
+Decorated to update_extract_cache, which acquires self.dir_lock, during
+initialisation.
+'''
+        cache = self._json_cache(_EXTRACT_CACHE_FILE)
+        for (cmd, data_file, digest, data_string) in entries:
+            cache[cmd] = (data_file, digest, data_string, program_digest)
+        for cmd in list(cache.keys()):
+            if not os.path.exists(os.path.join(self.path, cache[cmd][0])):
+                del cache[cmd]
+        self._save_json_cache(_EXTRACT_CACHE_FILE)
+
+    def _pass_key(self, test_input, test_arg):
+        '''Return a digest of the program, input file, benchmark and settings
+which determine whether the job passes or None if the digest cannot be formed
+(e.g. the benchmark does not exist).'''
+        tp_ptr = self.test_program
+        try:
+            bench_file = tp_ptr.select_benchmark_file(self.path, test_input,
+                                                      test_arg)
+        except exceptions.TestCodeError:
+            return None
+        # The programs are the same for all jobs, so are only read again if
+        # they have changed.
+        digests = [util.cached_file_digest(tp_ptr.exe),
+                   util.file_digest(os.path.join(self.path, bench_file))]
+        if test_input:
+            digests.append(util.file_digest(os.path.join(self.path,
+                                                         test_input)))
+        if tp_ptr.extract_program:
+            digests.append(util.cached_file_digest(tp_ptr.extract_program))
+        if None in digests:
+            return None
+        tolerances = sorted((str(name), repr(tol))
+                                for (name, tol) in self.tolerances.items())
+        # The repr of a function contains its address, which changes each
+        # time testcode is run, so use its (qualified) name instead.
+        extract_fn = tp_ptr.extract_fn
+        if extract_fn:
+            extract_fn = '%s.%s' % (extract_fn.__module__,
+                                    extract_fn.__name__)
+        settings = [tp_ptr.run_cmd_template, tp_ptr.launch_parallel,
+                    str(test_arg), str(self.nprocs), str(tp_ptr.data_tag),
+                    str(extract_fn), tp_ptr.extract_cmd_template,
+                    tp_ptr.extract_args, tp_ptr.extract_fmt,
+                    repr(tp_ptr.ignore_fields), repr(self.default_tolerance),
+                    repr(tolerances)]
+        return compat.sha1('\n'.join(digests + settings).encode('utf-8')
+                          ).hexdigest()
+
+    def _read_pass_cache(self):
+        '''Return a copy of the cache of jobs which passed.  Requires
+self.dir_lock.
+
+IMPORTANT: use self.read_pass_cache rather than self._read_pass_cache if using
+multiple threads.
+
+Decorated to read_pass_cache, which acquires self.dir_lock, during
+initialisation.
+'''
+        return dict(self._json_cache(_PASS_CACHE_FILE))
+
+    def _record_pass(self, test_input, test_arg, key):
+        '''Record that the job for test_input and test_arg passed with the
+inputs described by key (see _pass_key).  Requires self.dir_lock.
+
+IMPORTANT: use self.record_pass rather than self._record_pass if using multiple
+threads.
+
+Decorated to record_pass, which acquires self.dir_lock, during initialisation.
+'''
+        cache = self._json_cache(_PASS_CACHE_FILE)
+        name = repr((self.test_program.name, test_input, test_arg))
+        cache[name] = (key, self.test_program.test_file(test_input, test_arg))
+        self._save_json_cache(_PASS_CACHE_FILE)
+
+    def reuse_passes(self, verbose=1, rundir=None):
+        '''Mark jobs which passed previously, and whose inputs are unchanged,
+as passed.
+
+The output of the previous run of each such job is copied to the test output
+file.  Returns a dictionary of the remaining jobs, which need to be run, with
+(input file, arguments) keys and values given by _pass_key.
+
+No jobs are reused if TestProgram.use_caches is false.'''
+        if self.test_program.use_caches:
+            cache = self.read_pass_cache()
+        else:
+            cache = {}
+        pass_keys = {}
+        for (test_input, test_arg) in self.inputs_args:
+            key = self._pass_key(test_input, test_arg)
+            entry = cache.get(repr((self.test_program.name, test_input,
+                                    test_arg)))
+            test_file = self.test_program.test_file(test_input, test_arg)
+            if (key and entry and entry[0] == key and
+                    os.path.exists(os.path.join(self.path, entry[1]))):
+                if entry[1] != test_file:
+                    util.copy_file(os.path.join(self.path, entry[1]),
+                                   os.path.join(self.path, test_file))
+                status = validation.Status([True])
+                self._update_status(status, (test_input, test_arg))
+                msg = ('Test not rerun: unchanged since passing (output: %s).'
+                          % (entry[1],))
+                self.print_job_status(status, msg, test_input, test_arg,
+                                      verbose, rundir)
+            else:
+                pass_keys[(test_input, test_arg)] = key
+        return pass_keys
+
+    def _create_new_benchmarks(self, benchmark, copy_files_since=None,
+            copy_files_path='testcode_data', hardlink=False):
+        '''Copy the test files to benchmark files.  Requires self.dir_lock.
 
-        oldcwd = os.getcwd()
-        os.chdir(self.path)
+If hardlink is True, the benchmark files are created as hard links to the test
+files where possible rather than as copies.
 
+IMPORTANT: use self.create_new_benchmarks rather than
+self._create_new_benchmarks if using multiple threads.
+
+Decorated to create_new_benchmarks, which acquires self.dir_lock, during
+initialisation.
+'''
+
+        # Use paths relative to the test directory rather than changing
+        # directory, which affects all threads.
         test_files = []
         for (inp, arg) in self.inputs_args:
-            test_file = util.testcode_filename(FILESTEM['test'],
-                    self.test_program.test_id, inp, arg)
-            err_file = util.testcode_filename(FILESTEM['error'],
-                    self.test_program.test_id, inp, arg)
+            test_file = self.test_program.test_file(inp, arg)
+            err_file = self.test_program.error_file(inp, arg)
             bench_file = util.testcode_filename(_FILESTEM_DICT['benchmark'],
                     benchmark, inp, arg)
             test_files.extend((test_file, err_file, bench_file))
-            shutil.copy(test_file, bench_file)
+            # Only the contents are required; the permissions of the
+            # benchmark file need not match those of the test file.
+            util.copy_file(os.path.join(self.path, test_file),
+                           os.path.join(self.path, bench_file), hardlink)
 
         if copy_files_since:
+            copy_files_path = os.path.join(self.path, copy_files_path)
             if not os.path.isdir(copy_files_path):
                 os.mkdir(copy_files_path)
-            if os.path.isdir(copy_files_path):
-                for data_file in glob.glob('*'):
-                    if (os.path.isfile(data_file) and
-                            os.stat(data_file)[-2] >= copy_files_since and
-                            data_file not in test_files):
-                        bench_data_file = os.path.join(copy_files_path,
-                                data_file)
-                        # shutil.copy can't overwrite files so remove old ones
-                        # with the same name.
-                        if os.path.exists(bench_data_file):
-                            os.unlink(bench_data_file)
-                        shutil.copy(data_file, bench_data_file)
-
-        os.chdir(oldcwd)
+            # A single pass over the directory entries (which cache the
+            # file type and, on most platforms, stat information) rather
+            # than globbing and then querying each file separately.
+            # Hidden files are skipped, as with glob.  The checks which
+            # don't require a system call are made first.
+            test_files = compat.compat_set(test_files)
+            for entry in compat.scandir(self.path):
+                if (entry.name[0] != '.' and
+                        entry.name not in test_files and
+                        entry.is_file() and
+                        entry.stat().st_mtime >= copy_files_since):
+                    bench_data_file = os.path.join(copy_files_path,
+                            entry.name)
+                    # copy_file removes old files with the same name first,
+                    # as they might not be writable.
+                    util.copy_file(entry.path, bench_data_file,
+                                   hardlink)
+                    # Copy the permissions as for shutil.copymode but using
+                    # the (cached) stat information of the entry.
+                    os.chmod(bench_data_file,
+                             stat.S_IMODE(entry.stat().st_mode))
 
     def _update_status(self, status, inp_arg):
         '''Update self.status with success of a test.'''
+        self._status_summary = None
         if status:
             self.status[inp_arg] = status
         else:
@@ -668,16 +1518,122 @@ Assume function is executed in self.path.'''
         # If there's an object (other than None/False) in the corresponding
         # dict entry in self.status, then that test must have ran (albeit not
         # necessarily successfuly!).
-        status = {}
-        status['passed'] = sum(True for stat in self.status.values()
-                        if stat and stat.passed())
-        status['warning'] = sum(True for stat in self.status.values()
-                        if stat and stat.warning())
-        status['skipped'] = sum(True for stat in self.status.values()
-                        if stat and stat.skipped())
-        status['failed'] = sum(True for stat in self.status.values()
-                        if stat and stat.failed())
-        status['unknown'] = sum(True for stat in self.status.values()
-                        if stat and stat.unknown())
-        status['ran'] = sum(True for stat in self.status.values() if stat)
-        return status
+        # The summary is only recalculated if self.status has been updated
+        # since the last call.
+        if self._status_summary is not None:
+            return dict(self._status_summary)
+        status = dict.fromkeys(('passed', 'warning', 'skipped', 'failed',
+                                'unknown', 'ran'), 0)
+        # Count all statuses in a single pass over self.status.
+        for stat in self.status.values():
+            if stat:
+                status['ran'] += 1
+                if stat.passed():
+                    status['passed'] += 1
+                if stat.warning():
+                    status['warning'] += 1
+                if stat.skipped():
+                    status['skipped'] += 1
+                if stat.failed():
+                    status['failed'] += 1
+                if stat.unknown():
+                    status['unknown'] += 1
+        self._status_summary = status
+        return dict(status)
+
+def reset_started_jobs():
+    '''Forget the jobs started previously, so that they are run again (rather
+than their output being reused) if the tests are run again.'''
+    _STARTED_JOBS.clear()
+    _FAILED_JOBS.clear()
+
+def run_test_batch(tests, verbose=1, cluster_queue=None, rundir=None):
+    '''Run a batch of tests as a single job submitted to a queueing system.
+
+tests: list of tests.  All tests must use the same test program and submit
+    template and run on the same number of processors.  The job is submitted
+    from the directory of the first test.
+verbose, cluster_queue, rundir: as for Test.run_test.
+
+Submitting one job for many (short) tests rather than one job per test avoids
+waiting in the queue, and overloading the queueing system, once per test.  If
+TestProgram.submit_array is set (and Test.array_jobs is true for every test),
+the job is submitted as a job array so that the jobs can be run at the same
+time.
+'''
+    array = compat.compat_all([test.array_jobs() for test in tests])
+    batch = []
+    batch_cmds = []
+    claimed = []
+    shared = []
+    # Jobs claimed by each test must be released (see Test.jobs_to_run)
+    # whatever happens, as other tests sharing them wait for them to finish.
+    try:
+        for test in tests:
+            (inputs_args, pass_keys, shared_jobs) = test.jobs_to_run(verbose,
+                                                                     rundir)
+            claimed.append((test, inputs_args))
+            shared.append((test, shared_jobs, pass_keys))
+            try:
+                if not inputs_args:
+                    continue
+                checked = compat.compat_set()
+                for (test_input, test_arg) in inputs_args:
+                    if test_input not in checked:
+                        test.check_input(test_input)
+                        checked.add(test_input)
+                (test_cmds, test_files) = test.job_cmds(inputs_args)
+                test.move_old_output_files(verbose)
+            except exceptions.RunError:
+                test.fail_test(sys.exc_info()[1], test_input, test_arg,
+                               verbose, rundir, inputs_args)
+            else:
+                batch.append((test, inputs_args, pass_keys))
+                # Each test must be run in its own directory.
+                cd_cmd = 'cd %s' % (compat.quote(test.path),)
+                if array:
+                    job_cmds = test.cluster_job_cmds(test_cmds, test_files)
+                    batch_cmds.extend(['%s; %s' % (cd_cmd, cmd)
+                                           for cmd in job_cmds])
+                else:
+                    batch_cmds.append(cd_cmd)
+                    batch_cmds.append(test.cluster_cmd(test_cmds, test_files))
+        if array and len(batch_cmds) > 1:
+            batch_cmd = batch_cmds
+        else:
+            batch_cmd = '\n'.join(batch_cmds)
+        _run_batch_job(batch, batch_cmd, verbose, cluster_queue, rundir)
+    finally:
+        for (test, inputs_args) in claimed:
+            test.release_jobs(inputs_args)
+    for (test, shared_jobs, pass_keys) in shared:
+        test.verify_shared_jobs(shared_jobs, pass_keys, verbose, rundir)
+
+def _run_batch_job(batch, batch_cmd, verbose=1, cluster_queue=None,
+                   rundir=None):
+    '''Run the commands for a batch of tests and check the jobs in each test.
+
+batch: list of (test, inputs_args, pass_keys), where inputs_args and pass_keys
+    are as returned by Test.jobs_to_run.
+batch_cmd: command to run all jobs in the batch or a list of commands to be
+    submitted as a job array.
+verbose, cluster_queue, rundir: as for Test.run_test.'''
+    if not batch:
+        return
+
+    try:
+        job = batch[0][0].start_job(batch_cmd, cluster_queue, verbose)
+        job.wait()
+    except exceptions.RunError:
+        err = sys.exc_info()[1]
+        for (test, inputs_args, pass_keys) in batch:
+            (test_input, test_arg) = inputs_args[-1]
+            test.fail_test(err, test_input, test_arg, verbose, rundir,
+                           inputs_args)
+        return
+
+    for (test, inputs_args, pass_keys) in batch:
+        for (test_input, test_arg) in inputs_args:
+            test.verify_run_job(test_input, test_arg,
+                    pass_keys.get((test_input, test_arg)), verbose, rundir)
+        sys.stdout.flush()
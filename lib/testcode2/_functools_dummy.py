@@ -20,3 +20,25 @@ def wraps(func1):
             return func2(*args, **kwargs)
         return decorated_func
     return wrapper
+
+def lru_cache(maxsize=128):
+    '''Upgrade from python <3.2 to use functools.lru_cache.
+
+Results are stored in a dictionary, which is emptied (rather than only the least
+recently used result being discarded) once it holds maxsize results.  Only
+positional arguments are supported.'''
+    def wrapper(func):
+        '''Upgrade from python <3.2 to use functools.lru_cache.'''
+        cache = {}
+        def decorated_func(*args):
+            '''Upgrade from python <3.2 to use functools.lru_cache.'''
+            try:
+                return cache[args]
+            except KeyError:
+                if maxsize is not None and len(cache) >= maxsize:
+                    cache.clear()
+                val = func(*args)
+                cache[args] = val
+                return val
+        return decorated_func
+    return wrapper
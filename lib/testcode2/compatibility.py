@@ -21,6 +21,9 @@ in the main source code.
 :license: modified BSD; see LICENSE for more details.
 '''
 
+import glob
+import os
+import re
 import sys
 
 ### python 2.4 ###
@@ -61,8 +64,21 @@ try:
 except ImportError:
     import testcode2._functools_dummy as functools
 
+# hashlib was introduced in python 2.5.
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
 ### python 2.4, python 2.5 ###
 
+# json was introduced in python 2.6.  It is only required for the caches of
+# extracted data and passed jobs, which are not available without it.
+try:
+    import json
+except ImportError:
+    json = None
+
 # math.isnan was introduced in python 2.6, so need a workaround for 2.4 and 2.5.
 try:
     from math import isnan
@@ -141,12 +157,110 @@ except ImportError:
             return os.path.curdir
         return os.path.join(*rel_list)
 
+### python 2, python <3.2 ###
+
+# functools.lru_cache was introduced in python 3.2.
+try:
+    from functools import lru_cache
+except ImportError:
+    from testcode2._functools_dummy import lru_cache
+
+### python 2, python <3.3 ###
+
+# shlex.quote was introduced in python 3.3; pipes (deprecated in python 3.11)
+# provided it previously.
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# os.replace was introduced in python 3.3.  os.rename overwrites an existing
+# destination on POSIX systems, which is all that is required.
+try:
+    from os import replace
+except ImportError:
+    replace = os.rename
+
+### python 2, python <3.4 ###
+
+# importlib.util.find_spec was introduced in python 3.4.
+try:
+    from importlib.util import find_spec
+    def module_available(name):
+        '''Return True if the (top-level) module name can be imported.
+
+The module is located but not imported.'''
+        return find_spec(name) is not None
+except ImportError:
+    import imp
+    def module_available(name):
+        '''Return True if the (top-level) module name can be imported.
+
+The module is located but not imported.  Replacement for
+importlib.util.find_spec for python <3.4.'''
+        try:
+            imp.find_module(name)
+            return True
+        except ImportError:
+            return False
+
+### python 2, python <3.5 ###
+
+# os.scandir was introduced in python 3.5.
+try:
+    from os import scandir
+except ImportError:
+    class _DirEntry(object):
+        '''Minimal replacement for os.DirEntry for python <3.5.'''
+        def __init__(self, ddir, name):
+            self.name = name
+            self.path = os.path.join(ddir, name)
+        def is_dir(self):
+            '''Return True if the entry is a directory.'''
+            return os.path.isdir(self.path)
+        def is_file(self):
+            '''Return True if the entry is a file.'''
+            return os.path.isfile(self.path)
+        def stat(self):
+            '''Return a stat_result object for the entry.'''
+            return os.stat(self.path)
+    def scandir(path='.'):
+        '''Return the entries in the directory given by path.
+
+Replacement for os.scandir for python <3.5.
+'''
+        return [_DirEntry(path, name) for name in os.listdir(path)]
+
+### python 2, python <3.10 ###
+
+# glob.glob can match patterns relative to a directory other than the current
+# working directory (root_dir) from python 3.10.
+if sys.version_info[:2] >= (3, 10):
+    def glob_in_dir(pattern, path):
+        '''Return the names (relative to the directory path) matching
+pattern.'''
+        return glob.glob(pattern, root_dir=path)
+else:
+    def glob_in_dir(pattern, path):
+        '''Return the names (relative to the directory path) matching
+pattern.
+
+Replacement for glob.glob(pattern, root_dir=path) for python <3.10.
+'''
+        if os.path.isabs(pattern):
+            return glob.glob(pattern)
+        # Only expand wildcards in pattern and not in path.
+        escaped = re.sub(r'([*?[])', r'[\1]', path)
+        prefix = len(os.path.join(path, ''))
+        return [name[prefix:] for name in
+                    glob.glob(os.path.join(escaped, pattern))]
+
 ### python 2 ###
 
 try:
-    import configparser
+    import queue
 except ImportError:
-    import ConfigParser as configparser
+    import Queue as queue
 
 try:
     compat_input = raw_input
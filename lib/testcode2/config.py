@@ -8,29 +8,89 @@ Parse jobconfig and userconfig ini files.
 :license: modified BSD; see LICENSE for more details.
 '''
 
-import copy
 import glob
 import os
+import re
 import shlex
 import subprocess
+import sys
 import time
 import warnings
 
 import testcode2
 import testcode2.compatibility as compat
 import testcode2.exceptions as exceptions
+import testcode2.fastini as fastini
 import testcode2.util as util
 import testcode2.validation as validation
 import testcode2.vcs as vcs
 
+# Parsed configuration files, keyed by the absolute path to and modification
+# time of each file.  See read_config.
+_CONFIG_CACHE = {}
+
+# Options in a program section of the userconfig which set TestProgram
+# attributes and default Test settings respectively.
+_TEST_PROGRAM_OPTIONS = compat.compat_set(('run_cmd_template',
+        'launch_parallel', 'ignore_fields', 'data_tag', 'extract_cmd_template',
+        'extract_fn', 'extract_program', 'extract_args', 'extract_fmt',
+        'verify', 'vcs', 'skip_program', 'skip_args', 'skip_cmd_template',
+        'submit_batch_size', 'submit_array', 'cache_extracts', 'cache_passes',
+        'extract_server_mode', 'extract_server_template'))
+_DEFAULT_TEST_OPTIONS = compat.compat_set(('inputs_args', 'output', 'nprocs',
+        'min_nprocs', 'max_nprocs', 'submit_template'))
+
+def read_config(config_file):
+    '''Return the settings in config_file (see fastini.parse).
+
+The parsed file is cached and only parsed again if it has since been modified.
+The returned dictionary is hence shared and must not be modified; use
+copy_config to obtain a private copy.'''
+    key = (os.path.abspath(config_file), os.stat(config_file).st_mtime)
+    if key not in _CONFIG_CACHE:
+        _CONFIG_CACHE[key] = fastini.parse(config_file)
+    return _CONFIG_CACHE[key]
+
+def set_config_option(config_file, section, option, value):
+    '''Set option in section of config_file to value (see fastini.set_option).
+
+The cache used by read_config is updated so config_file is not parsed again if
+it is subsequently read.'''
+    path = os.path.abspath(config_file)
+    config = None
+    for key in list(_CONFIG_CACHE.keys()):
+        if key[0] == path:
+            config = _CONFIG_CACHE.pop(key)
+    fastini.set_option(config_file, section, option, value)
+    if config is not None:
+        config = copy_config(config)
+        config.setdefault(section, {})[option] = value
+        _CONFIG_CACHE[(path, os.stat(config_file).st_mtime)] = config
+
+def copy_config(config):
+    '''Return a copy of the settings, config, returned by read_config.'''
+    return dict((section, dict(options))
+                    for (section, options) in config.items())
+
+def set_options(config, settings, config_file):
+    '''Update config (as returned by read_config) with the options in
+settings, a dictionary of dictionaries of options for each section.'''
+    for (section_key, section) in settings.items():
+        if section_key not in config:
+            err = ('Cannot set options in section %s: section does not exist '
+                   'in %s.' % (section_key, config_file))
+            raise exceptions.TestCodeError(err)
+        config[section_key].update(section)
+
 def eval_nested_tuple(string):
     nested_tuple = compat.literal_eval(string)
     if isinstance(nested_tuple[0], (list, tuple)):
         return nested_tuple
     else:
-        # Append a comma to the option to ensure literal_eval returns a tuple
-        # of tuples, even if the option only contains a single tuple.
-        return compat.literal_eval('%s,' % string)
+        # Ensure a tuple of tuples is returned, even if the option only
+        # contains a single tuple.  (This is what appending a comma to the
+        # option would give but without parsing the option again.)
+        return (nested_tuple,)
 
 def parse_tolerance_tuple(val):
     '''Parse (abs_tol,rel_tol,name,strict).'''
@@ -52,6 +112,68 @@ def parse_tolerance_tuple(val):
         abs_tol = None
     return (name, validation.Tolerance(name, abs_tol, rel_tol, strict))
 
+# Tolerances parsed from each tolerance setting; see parse_tolerances.
+_TOLERANCE_CACHE = {}
+
+# A value in a tolerance tuple: None, a boolean, a (simple) quoted string or a
+# number.  See split_tolerances.
+_TOLERANCE_VALUE = (r'''(?:None|True|False|'[^'\\]*'|"[^"\\]*"|'''
+                    r'''[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)''')
+_TOLERANCE_VALUE_RE = re.compile(_TOLERANCE_VALUE)
+_TOLERANCE_TUPLE_RE = re.compile(
+        r'\s*\((\s*%s(?:\s*,\s*%s)*)\s*(,?)\s*\)\s*(?:,|$)'
+        % (_TOLERANCE_VALUE, _TOLERANCE_VALUE))
+
+def split_tolerances(string):
+    '''Split a tolerance setting into a tuple of tuples of values.
+
+Tolerance settings are almost always a list of tuples of numbers, None, True,
+False and quoted labels, which are split here rather than by (the considerably
+slower) literal_eval.  Returns None if string is not of this form (e.g. if a
+label contains a quotation mark), in which case eval_nested_tuple should be
+used instead.'''
+    tuples = []
+    pos = 0
+    while pos < len(string):
+        match = _TOLERANCE_TUPLE_RE.match(string, pos)
+        if not match:
+            return None
+        values = []
+        for token in _TOLERANCE_VALUE_RE.findall(match.group(1)):
+            if token == 'None':
+                values.append(None)
+            elif token in ('True', 'False'):
+                values.append(token == 'True')
+            elif token[0] in ('"', "'"):
+                values.append(token[1:-1])
+            else:
+                try:
+                    values.append(int(token))
+                except ValueError:
+                    values.append(float(token))
+        if len(values) == 1 and not match.group(2):
+            # Not a tuple: leave literal_eval to handle (or reject) it.
+            return None
+        tuples.append(tuple(values))
+        pos = match.end()
+    if not tuples:
+        return None
+    return tuple(tuples)
+
+def parse_tolerances(string):
+    '''Return a tuple of (name, Tolerance) pairs from a tolerance setting.
+
+The same setting (e.g. a default tolerance) is often given in many sections,
+so each setting is only parsed once.  The Tolerance objects are hence shared
+and must not be modified.'''
+    if string not in _TOLERANCE_CACHE:
+        tuples = split_tolerances(string)
+        if tuples is None:
+            tuples = eval_nested_tuple(string)
+        _TOLERANCE_CACHE[string] = tuple(parse_tolerance_tuple(item)
+                                         for item in tuples)
+    return _TOLERANCE_CACHE[string]
+
 def parse_userconfig(config_file, executables=None, test_id=None,
         settings=None):
     '''Parse the user options and job types from the userconfig file.
@@ -61,35 +183,33 @@ config_file: location of the userconfig file, either relative or absolute.'''
     if executables is None:
         executables = {}
 
-    if not os.path.exists(config_file):
-        raise exceptions.TestCodeError(
-                'User configuration file %s does not exist.' % (config_file)
-                                      )
     # paths to programs can be specified relative to the config
     # file.
     config_directory = os.path.dirname(os.path.abspath(config_file))
 
-    userconfig = compat.configparser.RawConfigParser()
-    userconfig.optionxform = str # Case sensitive file.
-    userconfig.read(config_file)
+    # Rather than checking config_file exists and then reading it, just read
+    # it and handle the error.
+    try:
+        userconfig = read_config(config_file)
+    except EnvironmentError:
+        err = 'Cannot read user configuration file %s: %s.' % (config_file,
+                                                sys.exc_info()[1].strerror)
+        raise exceptions.TestCodeError(err)
 
     # Alter config file with additional settings provided.
     if settings:
-        for (section_key, section) in settings.items():
-            for (option_key, value) in section.items():
-                userconfig.set(section_key, option_key, value)
+        # Leave the cached copy of the config file untouched.
+        userconfig = copy_config(userconfig)
+        set_options(userconfig, settings, config_file)
 
     # Sensible defaults for the user options.
     user_options = dict(benchmark=None, date_fmt='%d%m%Y',
             tolerance='(1.e-10,None)', output_files=None, diff='diff')
 
-    if userconfig.has_section('user'):
-        user_options.update(dict(userconfig.items('user')))
-        userconfig.remove_section('user')
+    if 'user' in userconfig:
+        user_options.update(userconfig['user'])
         user_options['tolerance'] = dict(
-                (parse_tolerance_tuple(item)
-                     for item in eval_nested_tuple(user_options['tolerance']))
-                                        )
+                parse_tolerances(user_options['tolerance']))
         if user_options['benchmark']:
             user_options['benchmark'] = user_options['benchmark'].split()
     else:
@@ -97,56 +217,58 @@ config_file: location of the userconfig file, either relative or absolute.'''
                 'user section in userconfig does not exist.'
                                       )
 
-    if not userconfig.sections():
+    # All other sections define programs.
+    program_sections = [section for section in userconfig
+                            if section != 'user']
+    if not program_sections:
         raise exceptions.TestCodeError(
                 'No job types specified in userconfig.'
                                       )
 
-    test_program_options = ('run_cmd_template',
-        'launch_parallel', 'ignore_fields', 'data_tag', 'extract_cmd_template',
-        'extract_fn', 'extract_program', 'extract_args', 'extract_fmt',
-        'verify', 'vcs', 'skip_program', 'skip_args', 'skip_cmd_template')
-    default_test_options = ('inputs_args', 'output', 'nprocs',
-        'min_nprocs', 'max_nprocs', 'submit_template',)
     test_programs = {}
-    for section in userconfig.sections():
+    for section in program_sections:
+        options = userconfig[section]
         tp_dict = {}
-        tolerances = copy.deepcopy(user_options['tolerance'])
+        # Tolerance objects are not modified, so only the dictionary of
+        # tolerances need be copied.
+        tolerances = dict(user_options['tolerance'])
         # Read in possible TestProgram settings.
-        for item in test_program_options:
-            if userconfig.has_option(section, item):
-                tp_dict[item] = userconfig.get(section, item)
+        for item in options:
+            if item in _TEST_PROGRAM_OPTIONS:
+                tp_dict[item] = options[item]
         if 'ignore_fields' in tp_dict:
             tp_dict['ignore_fields'] = shlex.split(tp_dict['ignore_fields'])
+        if 'submit_batch_size' in tp_dict:
+            tp_dict['submit_batch_size'] = int(tp_dict['submit_batch_size'])
+        for item in ('cache_extracts', 'cache_passes', 'extract_server_mode',
+                     'submit_array'):
+            if item in tp_dict:
+                tp_dict[item] = fastini.get_boolean(options, item)
         if section in executables:
             exe = executables[section]
         elif '_tc_all' in executables:
             exe = executables['_tc_all']
         else:
             exe = 'exe'
-        if userconfig.has_option(section, exe):
+        if exe in options:
             # exe is set to be a key rather than the path to an executable.
             # Expand.
-            exe = userconfig.get(section, exe)
+            exe = options[exe]
         # Create a default test settings.
         # First, tolerances...
-        if userconfig.has_option(section, 'tolerance'):
-            for item in (
-                    eval_nested_tuple(userconfig.get(section, 'tolerance'))
-                        ):
-                (name, tol) = parse_tolerance_tuple(item)
-                tolerances[name] = tol
+        if 'tolerance' in options:
+            tolerances.update(parse_tolerances(options['tolerance']))
         test_dict = dict(
                          default_tolerance=tolerances[None],
                          tolerances=tolerances,
                         )
         # Other settings...
-        for item in default_test_options:
-            if userconfig.has_option(section, item):
-                test_dict[item] = userconfig.get(section, item)
-        if userconfig.has_option(section, 'run_concurrent'):
-            test_dict['run_concurrent'] = \
-                    userconfig.getboolean(section, 'run_concurrent')
+        for item in options:
+            if item in _DEFAULT_TEST_OPTIONS:
+                test_dict[item] = options[item]
+        if 'run_concurrent' in options:
+            test_dict['run_concurrent'] = fastini.get_boolean(options,
+                                                              'run_concurrent')
         # Programs can be specified relative to the config directory.
         exe = set_program_name(exe, config_directory)
         if 'extract_program' in tp_dict:
@@ -187,87 +309,81 @@ def parse_jobconfig(config_file, user_options, test_programs, settings=None):
 
 config_file: location of the jobconfig file, either relative or absolute.'''
 
-    if not os.path.exists(config_file):
-        raise exceptions.TestCodeError(
-                'Job configuration file %s does not exist.' % (config_file)
-                                      )
-
     # paths to the test directories can be specified relative to the config
     # file.
     config_directory = os.path.dirname(os.path.abspath(config_file))
 
-    jobconfig = compat.configparser.RawConfigParser()
-    jobconfig.optionxform = str # Case sensitive file.
-    jobconfig.read(config_file)
+    try:
+        jobconfig = fastini.parse(config_file)
+    except EnvironmentError:
+        err = 'Cannot read job configuration file %s: %s.' % (config_file,
+                                                sys.exc_info()[1].strerror)
+        raise exceptions.TestCodeError(err)
 
     # Alter config file with additional settings provided.
     if settings:
-        for (section_key, section) in settings.items():
-            for (option_key, value) in section.items():
-                jobconfig.set(section_key, option_key, value)
+        set_options(jobconfig, settings, config_file)
 
     # Parse job categories.
     # Just store as list of test names for now.
-    if jobconfig.has_section('categories'):
-        test_categories = dict(jobconfig.items('categories'))
-        for (key, val) in test_categories.items():
-            test_categories[key] = val.split()
-        jobconfig.remove_section('categories')
-    else:
-        test_categories = {}
+    test_categories = dict((key, val.split()) for (key, val) in
+                                jobconfig.pop('categories', {}).items())
 
     # Parse individual sections for tests.
     # Note that sections/paths may contain globs and hence correspond to
     # multiple tests.
     # First, find out the tests each section corresponds to.
     test_sections = []
-    for section in jobconfig.sections():
+    for (section, options) in jobconfig.items():
         # Expand any globs in the path/section name and create individual Test
         # objects for each one.
-        if jobconfig.has_option(section, 'path'):
-            path = os.path.join(config_directory,
-                                jobconfig.get(section, 'path'))
-            jobconfig.remove_option(section, 'path')
-            globbed_tests = [(section, os.path.abspath(test_path))
+        # config_directory is absolute, so the paths need only be normalised
+        # rather than made absolute (which looks up the working directory
+        # each time).
+        if 'path' in options:
+            path = os.path.join(config_directory, options.pop('path'))
+            globbed_tests = [(section, os.path.normpath(test_path))
                                             for test_path in glob.glob(path)]
         else:
             path = os.path.join(config_directory, section)
-            globbed_tests = [(test_path, os.path.abspath(test_path))
+            globbed_tests = [(test_path, os.path.normpath(test_path))
                                             for test_path in glob.glob(path)]
         test_sections.append((section, globbed_tests))
     test_sections.sort(key=lambda sec_info: len(sec_info[1]), reverse=True)
     test_info = {}
+    # Looked up when first needed, as it need not be set if every section
+    # sets the program.
+    default_program = None
+    # Default test options of each program (see below).
+    default_settings = {}
     for (section, globbed_tests) in test_sections:
+        options = jobconfig[section]
         test_dict = {}
         # test program
-        if jobconfig.has_option(section, 'program'):
-            test_program = test_programs[jobconfig.get(section, 'program')]
+        if 'program' in options:
+            test_program = test_programs[options['program']]
         else:
-            test_program = test_programs[user_options['default_program']]
+            if default_program is None:
+                default_program = test_programs[
+                                            user_options['default_program']]
+            test_program = default_program
         # tolerances
-        if jobconfig.has_option(section, 'tolerance'):
-            test_dict['tolerances'] = {}
-            for item in (
-                    eval_nested_tuple(jobconfig.get(section,'tolerance'))
-                        ):
-                (name, tol) = parse_tolerance_tuple(item)
-                test_dict['tolerances'][name] = tol
-            jobconfig.remove_option(section, 'tolerance')
+        if 'tolerance' in options:
+            test_dict['tolerances'] = dict(
+                    parse_tolerances(options.pop('tolerance')))
             if None in test_dict['tolerances']:
                 test_dict['default_tolerance'] = test_dict['tolerances'][None]
         # inputs and arguments
-        if jobconfig.has_option(section, 'inputs_args'):
+        if 'inputs_args' in options:
             # format: (input, arg), (input, arg)'
             test_dict['inputs_args'] = (
-                    eval_nested_tuple(jobconfig.get(section, 'inputs_args')))
-            jobconfig.remove_option(section, 'inputs_args')
-        if jobconfig.has_option(section, 'run_concurrent'):
-            test_dict['run_concurrent'] = \
-                    jobconfig.getboolean(section, 'run_concurrent')
-            jobconfig.remove_option(section, 'run_concurrent')
+                    eval_nested_tuple(options.pop('inputs_args')))
+        if 'run_concurrent' in options:
+            test_dict['run_concurrent'] = fastini.get_boolean(options,
+                                                              'run_concurrent')
+            del options['run_concurrent']
         # Other options.
-        for option in jobconfig.options(section):
-            test_dict[option] = jobconfig.get(section, option)
+        test_dict.update(options)
         for key in ('nprocs', 'max_nprocs', 'min_nprocs'):
             if key in test_dict:
                 test_dict[key] = int(test_dict[key])
@@ -293,19 +409,22 @@ config_file: location of the jobconfig file, either relative or absolute.'''
             else:
                 # Create new test_info value.
                 # Merge with default values.
-                # Default test options.
-                default_test = test_program.default_test_settings
-                test = dict(
+                # Default test options (only gathered once per program).
+                if test_program.name not in default_settings:
+                    default_test = test_program.default_test_settings
+                    default_settings[test_program.name] = dict(
                         inputs_args=default_test.inputs_args,
                         output=default_test.output,
                         default_tolerance=default_test.default_tolerance,
-                        tolerances = copy.deepcopy(default_test.tolerances),
+                        tolerances = default_test.tolerances,
                         nprocs=default_test.nprocs,
                         min_nprocs=default_test.min_nprocs,
                         max_nprocs=default_test.max_nprocs,
                         run_concurrent=default_test.run_concurrent,
                         submit_template=default_test.submit_template,
                     )
+                test = dict(default_settings[test_program.name])
+                test['tolerances'] = dict(test['tolerances'])
                 if  'tolerances' in test_dict:
                     test['tolerances'].update(test_dict['tolerances'])
                     tol = test_dict.pop('tolerances')
@@ -313,14 +432,16 @@ config_file: location of the jobconfig file, either relative or absolute.'''
                 # restore tolerances for next test in the glob.
                 if tol:
                     test_dict['tolerances'] = tol
-                test_info[(name, path)] = [test_program, copy.deepcopy(test)]
+                # test only contains the (new) tolerances dictionary and
+                # values which are replaced rather than modified, so need not
+                # be copied.
+                test_info[(name, path)] = [test_program, test]
 
     # Now create the tests (after finding out what the input files are).
     tests = []
     for ((name, path), (test_program, test_dict)) in test_info.items():
-        old_dir = os.getcwd()
-        os.chdir(path)
-        # Expand any globs in the input files.
+        # Expand any globs in the input files (relative to the test directory
+        # rather than changing directory).
         inputs_args = []
         for input_arg in test_dict['inputs_args']:
             # Be a little forgiving for the input_args config option.
@@ -337,10 +458,18 @@ config_file: location of the jobconfig file, either relative or absolute.'''
             else:
                 inp = input_arg[0]
                 arg = ''
-            if inp:
+            if inp and not glob.has_magic(inp):
+                # Most input files are given explicitly, in which case just
+                # check the file exists rather than searching the directory.
+                if os.path.exists(os.path.join(path, inp)):
+                    inputs_args.append((inp, arg))
+                else:
+                    err = 'Cannot find input file %s in %s.' % (inp, path)
+                    warnings.warn(err)
+            elif inp:
                 # the test, error and benchmark filenames contain the input
                 # filename, so we need to filter them out.
-                inp_files = sorted(glob.glob(inp))
+                inp_files = sorted(compat.glob_in_dir(inp, path))
                 if not inp_files:
                     err = 'Cannot find input file %s in %s.' % (inp, path)
                     warnings.warn(err)
@@ -357,14 +486,19 @@ config_file: location of the jobconfig file, either relative or absolute.'''
                              ]
                 testcode_files = []
                 for tc_file in test_files:
-                    testcode_files.extend(glob.glob(tc_file))
+                    testcode_files.extend(compat.glob_in_dir(tc_file, path))
                 for inp_file in inp_files:
                     if inp_file not in testcode_files:
                         inputs_args.append((inp_file, arg))
             else:
                 inputs_args.append((inp, arg))
-        test_dict['inputs_args'] = tuple(inputs_args)
-        os.chdir(old_dir)
+        # Remove duplicate jobs (e.g. if an input file matches more than one
+        # glob), which would otherwise be run more than once.
+        unique_inputs_args = []
+        for input_arg in inputs_args:
+            if input_arg not in unique_inputs_args:
+                unique_inputs_args.append(input_arg)
+        test_dict['inputs_args'] = tuple(unique_inputs_args)
         # Create test.
         if test_dict['run_concurrent']:
             for input_arg in test_dict['inputs_args']:
@@ -380,15 +514,23 @@ def get_unique_test_id(tests, reuse_id=False, date_fmt='%d%m%Y'):
     '''Find a unique test id based upon the date and previously run tests.'''
     todays_id = time.strftime(date_fmt)
     newest_file = None
+    newest_mtime = None
     test_id = '0'*len(todays_id)
+    # Tests run concurrently share a directory: only search it once.
+    test_paths = []
     for test in tests:
+        if test.path not in test_paths:
+            test_paths.append(test.path)
+    for path in test_paths:
         test_globs = glob.glob('%s*' %
-                os.path.join(test.path, testcode2.FILESTEM['test'])
+                os.path.join(path, testcode2.FILESTEM['test'])
                               )
         for test_file in test_globs:
-            if (not newest_file or
-                    os.stat(test_file)[-2] > os.stat(newest_file)[-2]):
+            # Only stat each file once.
+            mtime = os.stat(test_file).st_mtime
+            if not newest_file or mtime > newest_mtime:
                 newest_file = test_file
+                newest_mtime = mtime
                 # keep track of the latest file with today's test_id (in case
                 # the most recent test was run with a user-specified test_id).
                 newest_test_id = util.testcode_file_id(
@@ -420,34 +562,47 @@ def select_tests(all_tests, test_categories, selected_categories, prefix=''):
     if ('_default_' in selected_categories
             and '_default_' not in test_categories):
         selected_categories = ['_all_']
-    # Recursively expand job categories.
+    # Recursively expand job categories.  Categories (and tests) included
+    # more than once need only be expanded and searched for once.
+    selected_categories = compat.compat_set(selected_categories)
     while compat.compat_any(
                     cat in test_categories for cat in selected_categories
                            ):
-        tmp = []
+        tmp = compat.compat_set()
         for cat in selected_categories:
             if cat in test_categories:
-                tmp.extend(test_categories[cat])
+                tmp.update(test_categories[cat])
             else:
                 # cat has been fully expanded and now refers to a test
                 # contained within the directory named cat.
-                tmp.append(cat)
+                tmp.add(cat)
         selected_categories = tmp
+    # Identify each test directory once (as os.path.samefile does) rather than
+    # for every category.
+    test_dir_ids = {}
+    for test in all_tests:
+        if test.path not in test_dir_ids and os.path.exists(test.path):
+            stat = os.stat(test.path)
+            test_dir_ids[test.path] = (stat.st_dev, stat.st_ino)
     # Select tests to run.
     tests = []
     parent = lambda pdir, cdir: \
             not os.path.relpath(cdir, start=pdir).startswith(os.pardir)
-    for cat in compat.compat_set(selected_categories):
+    for cat in selected_categories:
         # test paths are relative to the config directory but absolute paths
         # are stored .
         found = False
         cat_paths = glob.glob(os.path.join(prefix, cat))
+        cat_ids = compat.compat_set()
+        for path in cat_paths:
+            if os.path.exists(path):
+                stat = os.stat(path)
+                cat_ids.add((stat.st_dev, stat.st_ino))
         for test in all_tests:
             if cat == test.name:
                 found = True
                 tests.append(test)
-            elif compat.compat_any(os.path.exists(path) and
-                    os.path.samefile(path, test.path) for path in cat_paths):
+            elif test_dir_ids.get(test.path) in cat_ids:
                 found = True
                 tests.append(test)
             elif compat.compat_any(parent(path, test.path)
@@ -475,11 +630,11 @@ the full path.
         # Does program exist on the user's path?
         which_popen = subprocess.Popen(['which', program],
                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        which_popen.wait()
+        which_out = which_popen.communicate()[0]
         if which_popen.returncode == 0:
             # Program is on user's path.
             # Return full path to program.
-            program_path = which_popen.communicate()[0].decode('utf-8').strip()
+            program_path = which_out.decode('utf-8').strip()
         else:
             # Cannot find program.
             # This still allows us to manipulate previously run tests, just not
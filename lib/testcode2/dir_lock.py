@@ -21,14 +21,17 @@ class DirLock:
         
 :param function func: arbitary function.
 '''
+        # Look up the lock methods once rather than each time func is called.
+        acquire = self.lock.acquire
+        release = self.lock.release
         @compat.functools.wraps(func)
         def decorated_func(*args, **kwargs):
             '''Function decorated by Lock.with_lock.'''
-            self.lock.acquire()
+            acquire()
             try:
                 return func(*args, **kwargs)
             finally:
-                self.lock.release()
+                release()
         return decorated_func
     def in_dir(self, ddir):
         '''Decorate function so it is executed in the given directory ddir.
@@ -53,17 +56,51 @@ functions.
             @self.with_lock
             def decorated_func(*args, **kwargs):
                 '''Function decorated by Lock.in_dir.'''
-                cwd = os.getcwd()
-                os.chdir(ddir)
+                # Return to the original directory via a file descriptor where
+                # possible, which avoids looking up its path again.
                 try:
-                    val = func(*args, **kwargs)
-                except Exception:
-                    # func has raised an error.  Return to the original
-                    # directory and then re-raise the error to allow the caller
-                    # to handle it.
-                    os.chdir(cwd)
-                    raise
-                os.chdir(cwd)
-                return val
+                    restore = os.fchdir
+                    cwd = os.open(os.curdir, os.O_RDONLY)
+                except (AttributeError, OSError):
+                    # e.g. Windows.
+                    restore = os.chdir
+                    cwd = os.getcwd()
+                try:
+                    os.chdir(ddir)
+                    return func(*args, **kwargs)
+                finally:
+                    # Also reached if func raises an error, which is then
+                    # passed on to the caller.
+                    restore(cwd)
+                    if restore is os.fchdir:
+                        os.close(cwd)
             return decorated_func
         return wrapper
+
+# Locks for individual directories, keyed by the real path to the directory;
+# see get_dir_lock.
+_DIR_LOCKS = {}
+_DIR_LOCKS_LOCK = threading.Lock()
+
+def get_dir_lock(ddir):
+    '''Return the lock for accessing files in the directory ddir.
+
+The same lock is returned for all paths to the same directory, whereas threads
+working in different directories do not contend for a lock.  As changing
+directory affects all threads, a lock returned by get_dir_lock must not be used
+with DirLock.in_dir.
+
+:param string ddir: directory (or None).
+'''
+    key = ddir
+    if key:
+        key = os.path.realpath(key)
+    # Only lock if a new lock might need to be created.
+    if key not in _DIR_LOCKS:
+        _DIR_LOCKS_LOCK.acquire()
+        try:
+            if key not in _DIR_LOCKS:
+                _DIR_LOCKS[key] = DirLock()
+        finally:
+            _DIR_LOCKS_LOCK.release()
+    return _DIR_LOCKS[key]
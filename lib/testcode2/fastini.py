@@ -0,0 +1,172 @@
+'''
+testcode2.fastini
+-----------------
+
+Lightweight parsing of ini-style configuration files.
+
+testcode only needs the options and values in each section of its
+configuration files, so they are read directly into dictionaries rather than
+via (the considerably slower) RawConfigParser.  The format accepted is that of
+RawConfigParser without interpolation: lines starting with # or ; are comments,
+options are set using either = or : and a value is continued on subsequent
+indented lines.  Options are case-sensitive.  Options in the DEFAULT section
+apply to all other sections.  As for (strict) RawConfigParser in python 3, a
+section or an option within a section may only be given once.
+
+:copyright: (c) 2012 James Spencer.
+:license: modified BSD; see LICENSE for more details.
+'''
+
+import re
+
+import testcode2.exceptions as exceptions
+
+_SECTION = re.compile(r'\[(.+)\]')
+_DEFAULT = 'DEFAULT'
+_OPTION = re.compile(r'([^=:]+?)\s*[=:]\s*(.*)$')
+_COMMENT = ('#', ';')
+_BOOLEANS = {'1': True, 'yes': True, 'true': True, 'on': True,
+             '0': False, 'no': False, 'false': False, 'off': False}
+
+def parse(config_file):
+    '''Return the settings in config_file.
+
+:param string config_file: path to the configuration file.
+:returns: dictionary of sections, each of which is a dictionary of the options
+    and (string) values set in the section (including those set in the DEFAULT
+    section, which is not itself included).
+'''
+    # Configuration files are small, so read the whole file at once.
+    fconfig = open(config_file)
+    try:
+        lines = fconfig.read().splitlines()
+    finally:
+        fconfig.close()
+    sections = {}
+    options = None
+    # Lines of the value currently being read.
+    value = None
+    lineno = 0
+    for line in lines:
+        lineno += 1
+        stripped = line.strip()
+        if not stripped:
+            # Blank lines are only kept if the value is continued after them.
+            if value is not None:
+                value.append('')
+        elif stripped[0] in _COMMENT:
+            pass
+        elif value is not None and line[0].isspace():
+            value.append(stripped)
+        else:
+            match = _SECTION.match(stripped)
+            err = None
+            if match:
+                if match.group(1) in sections:
+                    err = 'section %s already exists' % (match.group(1),)
+                else:
+                    options = {}
+                    sections[match.group(1)] = options
+                    value = None
+                    continue
+            else:
+                match = _OPTION.match(stripped)
+                if options is None:
+                    err = 'no section header'
+                elif not match:
+                    err = 'cannot parse line'
+                elif match.group(1) in options:
+                    err = ('option %s already set in section' %
+                                                        (match.group(1),))
+            if err:
+                err = '%s (line %i of %s): %s' % (err, lineno, config_file,
+                                                  stripped)
+                raise exceptions.TestCodeError(err)
+            value = [match.group(2)]
+            options[match.group(1)] = value
+    # Join the lines of each value.
+    for options in sections.values():
+        for (option, value) in options.items():
+            options[option] = '\n'.join(value).strip()
+    # Apply the defaults to all other sections.
+    defaults = sections.pop(_DEFAULT, {})
+    for options in sections.values():
+        for (option, value) in defaults.items():
+            if option not in options:
+                options[option] = value
+    return sections
+
+def get_boolean(options, option):
+    '''Return the value of option in options as a boolean.
+
+As for RawConfigParser.getboolean, 1, yes, true and on are True and 0, no, false
+and off are False (regardless of case).
+
+:param dict options: a section returned by parse.
+:param string option: name of option.
+'''
+    value = options[option]
+    try:
+        return _BOOLEANS[value.lower()]
+    except KeyError:
+        err = 'Not a boolean: %s = %s' % (option, value)
+        raise exceptions.TestCodeError(err)
+
+def set_option(config_file, section, option, value):
+    '''Set option in section of config_file to value.
+
+Only the lines setting the option are changed, so (unlike RawConfigParser.write)
+comments and the layout of the rest of the file are kept.  The option, and the
+section if necessary, are added to the end of the section (file) if not already
+present.
+
+:param string config_file: path to the configuration file.
+:param string section: name of section.
+:param string option: name of option.
+:param string value: value of option.
+'''
+    fconfig = open(config_file)
+    try:
+        lines = fconfig.readlines()
+    finally:
+        fconfig.close()
+    if lines and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    new_lines = ['%s = %s\n' % (option, value.replace('\n', '\n\t'))]
+    # Find the lines (start:stop) setting the option, including any
+    # continuation lines, and the end of the section.
+    (start, stop, end) = (None, None, None)
+    in_section = False
+    is_option = False
+    for (ind, line) in enumerate(lines):
+        stripped = line.strip()
+        if not stripped or stripped[0] in _COMMENT:
+            continue
+        match = _SECTION.match(stripped)
+        if match:
+            if in_section:
+                break
+            in_section = match.group(1) == section
+            is_option = False
+        elif in_section:
+            if not line[0].isspace():
+                match = _OPTION.match(stripped)
+                is_option = match is not None and match.group(1) == option
+                if is_option:
+                    start = ind
+            if is_option:
+                stop = ind + 1
+        if in_section:
+            end = ind + 1
+    if end is None:
+        # New section.
+        lines.extend(['\n', '[%s]\n' % (section,)] + new_lines)
+    elif start is None:
+        lines[end:end] = new_lines
+    else:
+        lines[start:stop] = new_lines
+    fconfig = open(config_file, 'w')
+    try:
+        fconfig.writelines(lines)
+    finally:
+        fconfig.close()
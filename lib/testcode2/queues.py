@@ -13,8 +13,15 @@ import subprocess
 import sys
 import time
 
+import testcode2.dir_lock as dir_lock
 import testcode2.exceptions as exceptions
 
+# Status of all jobs in each queueing system, shared by all jobs waiting at the
+# same time so that the queueing system is not queried separately for each
+# job: {queue_cmd: (time of query, {job_id: status})}.
+_QUEUE_STATUS = {}
+_QUEUE_STATUS_LOCK = dir_lock.DirLock()
+
 class ClusterQueueJob:
     '''Interface to external queueing system.
 
@@ -22,13 +29,20 @@ class ClusterQueueJob:
     queueing system.
 :param string system: name of queueing system.  Currently only an interface to
     PBS is implemented.
+:param string path: directory in which the submit file is created and from
+    which the job is submitted.  Default: current working directory.
 '''
-    def __init__(self, submit_file, system='PBS'):
+    def __init__(self, submit_file, system='PBS', path=os.curdir):
         self.job_id = None
         self.submit_file = submit_file
         self.system = system
+        self.path = path
+        # Number of jobs in the job array (see create_submit_file).
+        self.array_size = 0
         if self.system == 'PBS':
             self.submit_cmd = 'qsub'
+            self.array_option = '-t'
+            self.array_id_var = 'PBS_ARRAYID'
             self.queue_cmd = 'qstat'
             self.job_id_column = 0
             self.status_column = 4
@@ -36,16 +50,29 @@ class ClusterQueueJob:
         else:
             err = 'Queueing system not implemented: %s' % self.system
             raise exceptions.RunError(err)
+        self.queue_status = _QUEUE_STATUS_LOCK.with_lock(self._queue_status)
     def create_submit_file(self, pattern, string, template):
         '''Create a submit file.
         
 Replace pattern in the template file with string and place the result in
-self.submit_file.
+self.submit_file in self.path.
+
+If string is a list of commands, the job is submitted as a job array with one
+job for each command, so that the commands can be run at the same time (on
+different nodes).  Each job runs only the command corresponding to its index in
+the array.
 
 :param string pattern: string in template to be replaced.
-:param string string: string to replace pattern in template.
+:param string string: string (or list of strings) to replace pattern in
+    template.
 :param string template: filename of file containing the template submit script.
 '''
+        if isinstance(string, list):
+            self.array_size = len(string)
+            cases = ['%i)\n%s\n;;' % (ind, cmd)
+                         for (ind, cmd) in enumerate(string)]
+            string = 'case $%s in\n%s\nesac' % (self.array_id_var,
+                                                 '\n'.join(cases))
         # get template
         if not os.path.exists(template):
             err = 'Submit file template does not exist: %s.' % (template,)
@@ -56,16 +83,18 @@ self.submit_file.
         # replace marker with our commands
         submit = submit.replace(pattern, string)
         # write to submit script
-        fsubmit = open(self.submit_file, 'w')
+        fsubmit = open(os.path.join(self.path, self.submit_file), 'w')
         fsubmit.write(submit)
         fsubmit.close()
     def start_job(self):
         '''Submit job to cluster queue.'''
         submit_cmd = [self.submit_cmd, self.submit_file]
+        if self.array_size:
+            submit_cmd[1:1] = [self.array_option, '0-%i' % (self.array_size-1)]
         try:
             submit_popen = subprocess.Popen(submit_cmd, stdout=subprocess.PIPE,
-                                            stderr=subprocess.STDOUT)
-            submit_popen.wait()
+                                            stderr=subprocess.STDOUT,
+                                            cwd=self.path)
             self.job_id = submit_popen.communicate()[0].strip().decode('utf-8')
         except OSError:
             # 'odd' syntax so exceptions work with python 2.5 and python 2.6/3.
@@ -74,25 +103,55 @@ self.submit_file.
     def wait(self):
         '''Returns when job has finished running on the cluster.'''
         running = True
+        while running:
+            since = time.time()
+            time.sleep(15)
+            # Assume job has finished unless it appears in the queue.  (A job
+            # array is listed by qstat as a single job with the job id returned
+            # by qsub.)
+            status = self.queue_status(since)
+            running = (status.get(self.job_id, self.finished_status)
+                           != self.finished_status)
+    def _queue_status(self, since):
+        '''Get the status of all jobs in the queueing system.
+Requires _QUEUE_STATUS_LOCK.
+
+The queueing system is only queried if it has not been queried (by any job)
+since the time since.
+
+IMPORTANT: use self.queue_status rather than self._queue_status if using
+multiple threads.
+
+Decorated to queue_status, which acquires _QUEUE_STATUS_LOCK, during
+initialisation.
+
+:param float since: time (in seconds since the epoch).
+:returns: dictionary of job status with job ids as keys.
+'''
+        if (self.queue_cmd in _QUEUE_STATUS and
+                _QUEUE_STATUS[self.queue_cmd][0] >= since):
+            return _QUEUE_STATUS[self.queue_cmd][1]
         # Don't ask the queueing system for the job itself but rather parse the
         # output from all current jobs and look  gor the job in question. 
         # This works around the problem where the job_id is not a sufficient
         # handle to query the system directly (e.g. on the CMTH cluster).
         qstat_cmd = [self.queue_cmd]
-        while running:
-            time.sleep(15)
-            qstat_popen = subprocess.Popen(qstat_cmd, stdout=subprocess.PIPE,
-                                           stderr=subprocess.PIPE)
-            qstat_popen.wait()
-            if qstat_popen.returncode != 0:
-                err = ('Error inspecting queue system: %s' %
-                                                      qstat_popen.communicate())
-                raise exceptions.RunError(err)
-            qstat_out = qstat_popen.communicate()[0]
-            # Assume job has finished unless it appears in the qstat output.
-            running = False
-            for line in qstat_out.splitlines():
-                words = line.split()
-                if words[self.job_id_column] == self.job_id:
-                    running = words[self.status_column] != self.finished_status
-                    break
+        query_time = time.time()
+        qstat_popen = subprocess.Popen(qstat_cmd, stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+        # Read all output (which can be large on a busy cluster) whilst
+        # waiting for qstat to finish.
+        (qstat_out, qstat_err) = qstat_popen.communicate()
+        if qstat_popen.returncode != 0:
+            err = ('Error inspecting queue system: %s' %
+                                            ((qstat_out, qstat_err),))
+            raise exceptions.RunError(err)
+        qstat_out = qstat_out.decode('utf-8')
+        status = {}
+        ncols = max(self.job_id_column, self.status_column) + 1
+        for line in qstat_out.splitlines():
+            words = line.split()
+            if len(words) >= ncols and words[self.job_id_column] not in status:
+                status[words[self.job_id_column]] = words[self.status_column]
+        _QUEUE_STATUS[self.queue_cmd] = (query_time, status)
+        return status
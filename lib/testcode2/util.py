@@ -8,6 +8,8 @@ Utility functions.
 :license: modified BSD; see LICENSE for more details.
 '''
 
+import errno
+import mmap
 import os.path
 import re
 import sys
@@ -15,8 +17,14 @@ import sys
 import testcode2.compatibility as compat
 import testcode2.exceptions as exceptions
 
+@compat.lru_cache(maxsize=4096)
 def testcode_filename(stem, file_id, inp, args):
-    '''Construct filename in testcode format.'''
+    '''Construct filename in testcode format.
+
+The same filenames are required repeatedly (e.g. when running, comparing and
+creating benchmarks), so they are cached.  The names of test output, error and
+benchmark files are also held by each TestProgram, so only a limited number of
+results are kept here.'''
     filename = '%s.%s' % (stem, file_id)
     if inp:
         filename = '%s.inp=%s' % (filename, inp)
@@ -26,6 +34,110 @@ def testcode_filename(stem, file_id, inp, args):
     filename = filename.replace('/', '_')
     return filename
 
+def move_file(src, dest):
+    '''Move the file src to dest, overwriting dest if it exists.
+
+A rename is attempted first as it is a single system call; shutil.move (which
+copies the file) is only used if that fails, e.g. if src and dest are on
+different filesystems.'''
+    try:
+        compat.replace(src, dest)
+    except OSError:
+        # shutil is comparatively slow to import and rarely needed.
+        import shutil
+        shutil.move(src, dest)
+
+# ioctl request (_IOW(0x94, 9, int)) to share the data of a file with another
+# file on filesystems supporting copy-on-write clones (e.g. btrfs and XFS).
+_FICLONE = 0x40049409
+
+def copy_file(src, dest, hardlink=False):
+    '''Copy the contents of the file src to dest, overwriting dest if it exists.
+
+If hardlink is True, dest is made a hard link to src if possible: no data are
+copied but subsequent changes to either file also change the other.  Otherwise
+dest is made a copy-on-write clone of src where the filesystem supports it.
+A normal copy is made if neither is possible (e.g. if src and dest are on
+different filesystems).
+
+dest is removed before being replaced, as it might be a hard link to src (e.g.
+if the benchmark was previously created with hardlink set), in which case
+writing to it would also overwrite src.'''
+    if os.path.realpath(src) == os.path.realpath(dest):
+        return
+    try:
+        os.unlink(dest)
+    except OSError:
+        if sys.exc_info()[1].errno != errno.ENOENT:
+            raise
+    if hardlink:
+        try:
+            os.link(src, dest)
+            return
+        except OSError:
+            pass
+    if not _clone_file(src, dest):
+        import shutil
+        shutil.copyfile(src, dest)
+
+def _clone_file(src, dest):
+    '''Make dest a copy-on-write clone of src.
+
+Returns True if successful and False if cloning is not supported.'''
+    if not sys.platform.startswith('linux'):
+        return False
+    import fcntl
+    src_file = open(src, 'rb')
+    try:
+        dest_file = open(dest, 'wb')
+        try:
+            try:
+                fcntl.ioctl(dest_file.fileno(), _FICLONE, src_file.fileno())
+            except (IOError, OSError):
+                return False
+        finally:
+            dest_file.close()
+    finally:
+        src_file.close()
+    return True
+
+def file_digest(filename):
+    '''Return the SHA-1 digest (as a hex string) of the contents of filename or
+None if filename cannot be read.'''
+    digest = compat.sha1()
+    try:
+        data_file = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        chunk = data_file.read(65536)
+        while chunk:
+            digest.update(chunk)
+            chunk = data_file.read(65536)
+    finally:
+        data_file.close()
+    return digest.hexdigest()
+
+# Digests of files which are used by many jobs (e.g. the program executable),
+# keyed by the path to, modification time and size of each file.  See
+# cached_file_digest.
+_FILE_DIGESTS = {}
+
+def cached_file_digest(filename):
+    '''Return file_digest(filename), only reading filename if it has changed
+since its digest was last computed.
+
+This is intended for (potentially large) files such as program executables
+which are common to many jobs.'''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    key = (filename, stat.st_mtime, stat.st_size)
+    if key not in _FILE_DIGESTS:
+        _FILE_DIGESTS[key] = file_digest(filename)
+    return _FILE_DIGESTS[key]
+
 def testcode_file_id(filename, stem):
     '''Extract the file_id from a filename in the testcode format.'''
     filename = os.path.basename(filename)
@@ -44,45 +156,77 @@ def try_floatify(val):
 
 def extract_tagged_data(data_tag, filename):
     '''Extract data from lines marked by the data_tag in filename.'''
-    if not os.path.exists(filename):
+    try:
+        data_file = open(filename, 'rb')
+    except IOError:
         err = 'Cannot extract data: file %s does not exist.' % (filename)
         raise exceptions.AnalysisError(err)
-    data_file = open(filename)
-    # Data tag is the first non-space character in the line.
-    # e.g. extract data from lines:
-    # data_tag      Energy:    1.256743 a.u.
-    data_tag_regex = re.compile('^ *%s' % (re.escape(data_tag)))
+    try:
+        lines = _find_tagged_lines(data_tag, data_file)
+    finally:
+        data_file.close()
     data = {}
-    for line in data_file.readlines():
-        if data_tag_regex.match(line):
-            # This is a line containing info to be tested.
-            words = line.split()
-            key = []
-            # name of data is string after the data_tag and preceeding the
-            # (numerical) data.  only use the first number in the line, with
-            # the key taken from all proceeding information.
-            for word in words[1:]:
-                val = try_floatify(word)
-                if val != word:
-                    break
-                else:
-                    key.append(word)
-            if key[-1] in ("=",':'):
-                key.pop()
-            key = '_'.join(key)
-            if key[-1] in ("=",':'):
-                key = key[:-1]
-            if not key:
-                key = 'data'
-            if key in data:
-                data[key].append(val)
+    for line in lines:
+        words = line.split()
+        key = []
+        # name of data is string after the data_tag and preceeding the
+        # (numerical) data.  only use the first number in the line, with
+        # the key taken from all proceeding information.
+        for word in words[1:]:
+            val = try_floatify(word)
+            if val != word:
+                break
             else:
-                data[key] = [val]
+                key.append(word)
+        if key[-1] in ("=",':'):
+            key.pop()
+        key = '_'.join(key)
+        if key[-1] in ("=",':'):
+            key = key[:-1]
+        if not key:
+            key = 'data'
+        if key in data:
+            data[key].append(val)
+        else:
+            data[key] = [val]
     # We shouldn't change the data from this point: convert entries to tuples.
     for (key, val) in data.items():
         data[key] = tuple(val)
     return data
 
+def _find_tagged_lines(data_tag, data_file):
+    '''Return the lines in the open (binary) file data_file marked by data_tag.
+
+The file is memory-mapped where possible so that it is searched for the data
+tag as a whole rather than examined a line at a time in python.'''
+    # Data tag is the first non-space character in the line.
+    # e.g. extract data from lines:
+    # data_tag      Energy:    1.256743 a.u.
+    tag = data_tag.encode('utf-8')
+    (newline, space) = ('\n'.encode('utf-8'), ' '.encode('utf-8'))
+    try:
+        contents = mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        # Empty files (and some special files) cannot be memory-mapped.
+        contents = data_file.read()
+    lines = []
+    try:
+        # Search for the data tag and then check that only spaces precede it
+        # on its line.
+        pos = contents.find(tag)
+        while pos != -1:
+            start = contents.rfind(newline, 0, pos) + 1
+            end = contents.find(newline, pos)
+            if end == -1:
+                end = len(contents)
+            if not contents[start:pos].strip(space):
+                lines.append(contents[start:end].decode('utf-8'))
+            pos = contents.find(tag, end + 1)
+    finally:
+        if isinstance(contents, mmap.mmap):
+            contents.close()
+    return lines
+
 def dict_table_string(table_string):
     '''Read a data table from a string into a dictionary.
 
@@ -101,19 +245,19 @@ and
      a  b  d  e
      7  8  9  6
 '''
-    data = [i.split() for i in table_string.splitlines()]
-    # Convert to numbers where appropriate
-    data = [[try_floatify(val) for val in dline] for dline in data]
     data_dict = {}
     head = []
-    for dline in data:
+    # Parse the table in a single pass, splitting each line and converting
+    # values to numbers where appropriate as it is reached.
+    for line in table_string.splitlines():
+        dline = [try_floatify(val) for val in line.split()]
         # Test if all items are strings; if so start a new subtable.
         # We actually test if all items are not floats, as python 3 can return
         # a bytes variable from subprocess whereas (e.g.) python 2.4 returns a
         # str.  Testing for this is problematic as the bytes type does not
         # exist in python 2.4.  Fortunately we have converted all items to
         # floats if possible, so can just test for the inverse condition...
-        if compat.compat_all(type(val) is not float for val in dline):
+        if float not in map(type, dline):
             # header of new subtable
             head = dline
             for val in head:
@@ -177,7 +321,9 @@ def pretty_print_table(labels, dicts):
     # Create header line as we go.
     fmt = dict(_tc_label='%%-%is' % (max(len(str(label)) for label in labels)))
     header = []
-    for key in sorted(dicts[0].keys()):
+    # All dicts now have the same keys, so only need to sort them once.
+    keys = sorted(dicts[0].keys())
+    for key in keys:
         fmt[key] = len(str(key))
         nitems = 1
         if type(dicts[0][key]) is tuple or type(dicts[0][key]) is list:
@@ -201,9 +347,8 @@ def pretty_print_table(labels, dicts):
     # ease we construct the formatting for the line and then print it.
     lines = [ header ]
     for (ind, label) in enumerate(labels):
-        line = [fmt['_tc_label'] % (label)]
         line = []
-        for key in sorted(dicts[ind].keys()):
+        for key in keys:
             if type(dicts[ind][key]) is tuple or type(dicts[ind][key]) is list:
                 for item in range(len(dicts[ind][key])):
                     line.append(fmt[key] % (dicts[ind][key][item]))
@@ -210,9 +210,50 @@ strict: if true, then require numbers to be within both thresholds.
         return (Status([passed]), msg)
 
 
+def compile_tolerances(default_tolerance, tolerances):
+    '''Return a function which returns the tolerance to use for a data item.
+
+default_tolerance: tolerance used for data items which are not matched by any
+                   tolerance in tolerances.
+tolerances: dictionary of tolerances.  A data item uses the tolerance with the
+            same name or, failing that, the first tolerance whose name is a
+            regular expression which matches it.
+
+The tolerance for each data item is only resolved the first time it is
+required.
+'''
+    tol_regexes = [(re.compile(tol.name), tol) for tol in tolerances.values()
+                                               if tol.name]
+    resolved = {}
+    def get_tolerance(param):
+        '''Return the tolerance to use for the data item param.'''
+        try:
+            return resolved[param]
+        except KeyError:
+            param_tol = tolerances.get(param, default_tolerance)
+            if param_tol == default_tolerance:
+                # See if there's a regex that matches.
+                tol_matches = [tol for (regex, tol) in tol_regexes
+                                   if regex.match(param)]
+                if tol_matches:
+                    param_tol = tol_matches[0]
+                    if len(tol_matches) > 1:
+                        warnings.warn('Multiple tolerance regexes match.  '
+                                      'Using %s.' % (param_tol.name))
+            resolved[param] = param_tol
+            return param_tol
+    return get_tolerance
+
 def compare_data(benchmark, test, default_tolerance, tolerances,
-        ignore_fields=None):
-    '''Compare two data dictionaries.'''
+        ignore_fields=None, get_tolerance=None):
+    '''Compare two data dictionaries.
+
+get_tolerance: function returned by compile_tolerances for default_tolerance and
+               tolerances.  Supply this if comparing many pairs of data
+               dictionaries with the same tolerances.
+'''
+    if get_tolerance is None:
+        get_tolerance = compile_tolerances(default_tolerance, tolerances)
     ignored_params = compat.compat_set(ignore_fields or tuple())
     bench_params = compat.compat_set(benchmark) - ignored_params
     test_params = compat.compat_set(test) - ignored_params
@@ -251,16 +292,7 @@ def compare_data(benchmark, test, default_tolerance, tolerances,
                            ", ".join(test_more))
 
     for param in (bench_params & test_params):
-        param_tol = tolerances.get(param, default_tolerance)
-        if param_tol == default_tolerance:
-            # See if there's a regex that matches.
-            tol_matches = [tol for tol in tolerances.values()
-                               if tol.name and re.match(tol.name, param)]
-            if tol_matches:
-                param_tol = tol_matches[0]
-                if len(tol_matches) > 1:
-                    warnings.warn('Multiple tolerance regexes match.  '
-                                  'Using %s.' % (param_tol.name))
+        param_tol = get_tolerance(param)
         for bench_value, test_value in zip(benchmark[param], test[param]):
             key_status, err = param_tol.validate(test_value, bench_value, param)
             status += key_status
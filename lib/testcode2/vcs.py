@@ -8,7 +8,6 @@ Lightweight access to required version control system functions.
 :license: modified BSD; see LICENSE for more details.
 '''
 
-import os
 import subprocess
 
 class VCSRepository(object):
@@ -29,21 +28,22 @@ remote_repository: remote location of the repository.
 
     def get_code_id(self):
         '''Return the id (i.e. version number or hash) of the VCS repository.'''
-        old_dir = os.getcwd()
-        os.chdir(self.repository)
         code_id = 'UNKNOWN'
         id_popen = None
+        # Run the VCS command in the repository rather than changing
+        # directory, which affects all threads.
         if self.vcs == 'svn':
             id_popen = subprocess.Popen(['svnversion', '.'],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    cwd=self.repository)
         elif self.vcs == 'git':
             id_popen = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    cwd=self.repository)
         elif self.vcs == 'hg':
             id_popen = subprocess.Popen(['hg', 'id', '-i'],
-                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    cwd=self.repository)
         if id_popen:
-            id_popen.wait()
             code_id = id_popen.communicate()[0].decode('utf-8').strip()
-        os.chdir(old_dir)
         return (code_id)